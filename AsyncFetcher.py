@@ -0,0 +1,150 @@
+'''
+Concurrent, rate-limit-aware fetching of Kaggle JSON endpoints.
+
+Requests go through one pooled requests.Session and are issued from
+a thread pool driven by asyncio. A token bucket caps the request rate
+and a semaphore bounds the number of requests in flight. The rate
+adapts to the server: a 429 halves it and backs off (honoring
+Retry-After when present), while every successful response raises it
+by a fixed fraction, so it climbs back to the quota within a few dozen
+requests. Requests in flight when the rate is cut were sent at the old
+rate, so their 429s do not cut it again. We therefore run at whatever
+quota the API currently allows.
+
+The base URL is configurable so the fetcher can be pointed at a local
+mock server, e.g. one started with http.server.
+'''
+
+import asyncio
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class TokenBucket(object):
+	def __init__(self, rate, capacity=None):
+		# Tokens added per second and maximum burst size
+		self.rate = float(rate)
+		self.capacity = float(capacity if capacity is not None else max(rate, 1.))
+		self.tokens = self.capacity
+		self.last_refill = time.monotonic()
+		self.lock = asyncio.Lock()
+
+
+	def refill(self):
+		now = time.monotonic()
+		self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+		self.last_refill = now
+
+
+	# Waits until a token is available and takes it
+	async def acquire(self):
+		async with self.lock:
+			while True:
+				self.refill()
+				if self.tokens >= 1.:
+					self.tokens -= 1.
+					return
+				await asyncio.sleep((1. - self.tokens) / self.rate)
+
+
+class AsyncFetcher(object):
+	def __init__(self, base_url="https://www.kaggle.com", rate=5., max_concurrency=8,\
+				min_rate=0.05, max_rate=50., max_retries=8, max_backoff=180., timeout=30., growth=0.05):
+		self.base_url = base_url.rstrip('/')
+		self.bucket = TokenBucket(rate)
+		self.min_rate = min_rate
+		self.max_rate = max_rate
+		self.growth = growth
+		self.max_retries = max_retries
+		self.max_backoff = max_backoff
+		self.timeout = timeout
+		self.max_concurrency = max_concurrency
+
+		# One connection per concurrent request
+		self.session = requests.Session()
+		adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+		self.session.mount("http://", adapter)
+		self.session.mount("https://", adapter)
+		self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+		self.semaphore = None
+
+		# Time of the last rate cut, see on_throttled
+		self.last_cut = float("-inf")
+
+		# Counters for reporting progress
+		self.num_requests = 0
+		self.num_throttled = 0
+
+
+	def close(self):
+		self.executor.shutdown(wait=True)
+		self.session.close()
+
+
+	# Multiplicative increase on success (at least 0.1 requests per second,
+	# so very low rates recover too), multiplicative decrease on 429
+	def on_success(self):
+		self.bucket.rate = min(self.max_rate, self.bucket.rate + max(0.1, self.bucket.rate * self.growth))
+
+
+	# sent_at is when the throttled request was sent; only requests sent
+	# after the last cut can cut the rate again
+	def on_throttled(self, sent_at):
+		self.num_throttled += 1
+		if sent_at < self.last_cut: return
+		self.bucket.rate = max(self.min_rate, self.bucket.rate / 2.)
+		self.bucket.tokens = min(self.bucket.tokens, 0.)
+		self.last_cut = time.monotonic()
+
+
+	# Seconds to wait before retrying after the attempt-th failure
+	def backoff(self, attempt, response=None):
+		if response is not None:
+			retry_after = response.headers.get("Retry-After")
+			if retry_after is not None and retry_after.isdigit(): return min(float(retry_after), self.max_backoff)
+		# Exponential backoff with full jitter
+		return random.uniform(0., min(self.max_backoff, 2. ** attempt))
+
+
+	# GETs base_url + path and returns the parsed JSON, or None if the
+	# request keeps failing or returns a non-retryable status code
+	async def fetch_json(self, path):
+		if self.semaphore is None: self.semaphore = asyncio.Semaphore(self.max_concurrency)
+		loop = asyncio.get_running_loop()
+		url = self.base_url + path
+
+		for attempt in range(self.max_retries + 1):
+			await self.bucket.acquire()
+			async with self.semaphore:
+				sent_at = time.monotonic()
+				try:
+					response = await loop.run_in_executor(self.executor, lambda: self.session.get(url, timeout=self.timeout))
+				except requests.RequestException:
+					response = None
+			self.num_requests += 1
+
+			if response is not None and response.status_code == 200:
+				self.on_success()
+				try:
+					return response.json()
+				except ValueError:
+					print("Error parsing JSON from " + url)
+					return None
+
+			if response is not None and response.status_code == 429: self.on_throttled(sent_at)
+			elif response is not None and response.status_code < 500:
+				print("Response status code " + str(response.status_code) + " for " + url)
+				return None
+
+			await asyncio.sleep(self.backoff(attempt, response))
+
+		print("Giving up on " + url)
+		return None
+
+
+	# Fetches every path concurrently, results are in the same order as paths
+	async def fetch_all(self, paths):
+		return await asyncio.gather(*[self.fetch_json(path) for path in paths])
@@ -0,0 +1,164 @@
+'''
+Batch evaluation of many simulation scenarios in one process.
+
+A scenario file holds one JSON object per line (or a single JSON list of
+them), each setting any of
+	name          -- label of the scenario in the results (default: its line number)
+	gold          -- gold competition (default: two-sigma-financial-news)
+	num_retained  -- number of users the gold competition retains (default: 100)
+	iterations    -- number of random allocations averaged over (default: 100)
+	payouts       -- payouts overriding those of V1Simulation.competitions_to_payouts
+	seed          -- seed for the random allocations (default: unseeded)
+	limit_entries -- as V1Simulation --limit_entries (default: false)
+for example
+	{"name": "small gold", "num_retained": 50, "seed": 0}
+	{"name": "rich elo", "payouts": {"elo-merchant-category-recommendation": 90000}, "seed": 0}
+
+The user and leaderboard data are loaded once and shared by every
+scenario, scenarios can be spread over worker processes, and results are
+streamed in scenario order as soon as they are known, one record per
+scenario and normal competition, as JSON Lines or CSV:
+	python BatchRunner.py scenarios.jsonl --output results.csv --workers 4
+
+Seeded scenarios are read from and written to the result cache of
+V1Simulation.
+'''
+
+import argparse
+import csv
+import json
+import sys
+import numpy as np
+import V1Simulation
+from ResultCache import ResultCache
+from UserStore import load_user_store
+
+# Defaults of every scenario field, see the module docstring
+SCENARIO_FIELDS = {"name": None, "gold": "two-sigma-financial-news", "num_retained": V1Simulation.num_retained,\
+					"iterations": 100, "payouts": {}, "seed": None, "limit_entries": False}
+
+# Fields of every result record
+RECORD_FIELDS = ("scenario", "gold_competition", "num_retained", "iterations", "seed", "competition", "payout",\
+				"gain", "half_width")
+
+# User store of a worker process, see init_worker
+worker_users = None
+
+
+# Reads the scenarios of a file of JSON Lines or of a JSON list, filling in defaults
+def load_scenarios(path):
+	with open(path, 'r') as f: text = f.read()
+
+	if text.lstrip().startswith("["): raw = json.loads(text)
+	else: raw = [json.loads(line) for line in text.splitlines() if line.strip()]
+
+	scenarios = []
+	for idx, fields in enumerate(raw):
+		unknown = set(fields) - set(SCENARIO_FIELDS)
+		if unknown: raise ValueError("Scenario " + str(idx) + " has unknown fields: " + ", ".join(sorted(unknown)))
+
+		scenario = dict(SCENARIO_FIELDS, **fields)
+		if scenario["name"] is None: scenario["name"] = str(idx)
+		scenarios.append(scenario)
+	return scenarios
+
+
+# Runs one scenario and returns its SimulationResult
+def run_scenario(users, scenario, cache=None):
+	competition_names = V1Simulation.get_leaderboard_store().competition_names()
+	gold_competition = scenario["gold"]
+	if gold_competition not in competition_names: raise ValueError("Unknown gold competition: " + gold_competition)
+
+	unknown = set(scenario["payouts"]) - set(competition_names)
+	if unknown: raise ValueError("Payouts of unknown competitions: " + ", ".join(sorted(unknown)))
+	payouts = dict(V1Simulation.competitions_to_payouts, **scenario["payouts"])
+
+	normal_competition_names = [name for name in competition_names if name != gold_competition]
+	return V1Simulation.perform_simulation(users, gold_competition, normal_competition_names, scenario["num_retained"],\
+											make_plots=False, save_plots=False, limit_entries=scenario["limit_entries"],\
+											rng=np.random.default_rng(scenario["seed"]), max_iterations=scenario["iterations"],\
+											cache=cache, seed=scenario["seed"], payouts=payouts, verbose=False)
+
+
+# One record per normal competition of a scenario's result
+def scenario_records(scenario, result):
+	payouts = dict(V1Simulation.competitions_to_payouts, **scenario["payouts"])
+	records = []
+	for comp_idx, competition in enumerate(result.competitions):
+		records.append({"scenario": scenario["name"], "gold_competition": result.gold_competition,\
+						"num_retained": int(result.num_retained), "iterations": int(result.num_iterations),\
+						"seed": scenario["seed"], "competition": competition, "payout": payouts[competition],\
+						"gain": float(result.gains[comp_idx]), "half_width": float(result.half_widths[comp_idx])})
+	return records
+
+
+# Workers keep the user store (and the index built from it) and the
+# leaderboards for every scenario they run
+def init_worker(users):
+	global worker_users
+	worker_users = users
+	V1Simulation.get_leaderboard_store()
+
+
+# Runs a scenario in a worker process; kept at module level so that it can be sent to workers
+def run_worker_scenario(cache, scenario):
+	return scenario_records(scenario, run_scenario(worker_users, scenario, cache))
+
+
+# Yields the records of every scenario in order, each list as soon as the scenario is done
+def run_batch(users, scenarios, workers=1, cache=None):
+	if workers == 1:
+		for scenario in scenarios: yield scenario_records(scenario, run_scenario(users, scenario, cache))
+		return
+
+	# Loaded here so forked workers inherit the leaderboards instead of parsing them again
+	V1Simulation.get_leaderboard_store()
+	from concurrent.futures import ProcessPoolExecutor
+	# Scenarios are sent in chunks, a few per worker, to keep the messaging overhead low
+	chunksize = max(1, len(scenarios) // (4 * workers))
+	with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(users,)) as executor:
+		for records in executor.map(run_worker_scenario, [cache] * len(scenarios), scenarios, chunksize=chunksize):
+			yield records
+
+
+# Writes batches of records to the file f as JSON Lines or CSV, flushing after every batch
+def write_records(batches, f, output_format="jsonl"):
+	writer = None
+	if output_format == "csv":
+		writer = csv.DictWriter(f, fieldnames=RECORD_FIELDS)
+		writer.writeheader()
+
+	for records in batches:
+		for record in records:
+			if writer is not None: writer.writerow(record)
+			else: f.write(json.dumps(record) + "\n")
+		f.flush()
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("scenarios", help="file of scenarios as JSON Lines or a JSON list")
+	parser.add_argument("-o", "--output", help="file to write the results to, - for standard output", default="-")
+	parser.add_argument("--format", help="format of the results, by default csv for .csv outputs and jsonl otherwise",\
+						choices=["jsonl", "csv"], default=None)
+	parser.add_argument("-w", "--workers", help="number of processes the scenarios are spread over", type=int, default=1)
+	parser.add_argument("--cache_dir", help="directory of the cache of seeded simulation results", default="simulation_cache")
+	parser.add_argument("--cache_size", help="maximum size of the result cache in MB", type=float, default=256.)
+	parser.add_argument("--no_cache", help="neither read nor write the result cache", action="store_true")
+	args = parser.parse_args()
+
+	output_format = args.format
+	if output_format is None: output_format = "csv" if args.output.endswith(".csv") else "jsonl"
+
+	scenarios = load_scenarios(args.scenarios)
+	cache = ResultCache(args.cache_dir, int(args.cache_size * 2 ** 20)) if not args.no_cache else None
+	users = load_user_store("kaggle_users_store", "kaggle_users.npy")
+
+	batches = run_batch(users, scenarios, args.workers, cache)
+	if args.output == "-": write_records(batches, sys.stdout, output_format)
+	else:
+		with open(args.output, 'w', newline='') as f: write_records(batches, f, output_format)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,236 @@
+'''
+Benchmarks for the hot paths of the simulation.
+
+Times get_competitors, allocate_eliminated, compute_gains, one
+perform_simulation and a full find_best_num_retained sweep on the
+shipped data, and on copies of it scaled up in both the number of
+users and the number of competitions. Timings are written as JSON,
+and can be compared against an earlier run to catch regressions:
+	python Benchmark.py --scales 10 100 --output benchmark.json
+	python Benchmark.py --baseline benchmark.json
+
+Datasets written by SyntheticData.py can be benchmarked too:
+	python Benchmark.py --scales 1 --datasets synthetic
+'''
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+import numpy as np
+import V1Simulation
+from LeaderboardStore import LeaderboardStore
+from SyntheticData import load_synthetic_dataset
+from UserStore import TIERS, UserStore, load_user_store, write_user_store
+
+# Gold competition of the shipped data, as in V1Simulation.main
+gold_competition = "two-sigma-financial-news"
+
+
+# Name of the copy-th copy of a user or competition; copy 0 keeps the original name
+def copy_name(name, copy):
+	return name if copy == 0 else name + "#" + str(copy)
+
+
+# Writes a copy of the shipped data scaled up by an integer factor to out_dir.
+# Every user and every leaderboard is copied scale times, where copy j of a
+# leaderboard holds copy j of each of its users. Returns (users, store, payouts).
+def write_scaled_dataset(users, store, scale, out_dir, payouts):
+	names = users.names()
+	tiers = [TIERS[code] for code in users.tiers]
+	points = users.points.tolist()
+	user_ids = users.user_ids.tolist()
+	id_offset = max(user_ids) + 1
+
+	user_data = ({"displayName": copy_name(names[idx], copy), "tier": tiers[idx], "points": points[idx],\
+					"userId": user_ids[idx] + copy * id_offset} for copy in range(scale) for idx in range(len(names)))
+	write_user_store(user_data, os.path.join(out_dir, "users"))
+
+	leaderboards_dir = os.path.join(out_dir, "leaderboards")
+	os.mkdir(leaderboards_dir)
+	scaled_payouts = {}
+	for competition in store.competition_names():
+		for copy in range(scale):
+			name = copy_name(competition, copy)
+			scaled_payouts[name] = payouts[competition]
+
+			# Only the username column is ever read
+			with open(os.path.join(leaderboards_dir, name + "-publicleaderboard.csv"), 'w', encoding="utf-8") as f:
+				f.write("TeamId,TeamName,SubmissionDate,Score\n")
+				for rank, username in enumerate(store.usernames(competition)):
+					f.write(str(rank) + "," + copy_name(username, copy) + ",,\n")
+
+	scaled_store = LeaderboardStore(leaderboards_dir, os.path.join(out_dir, "leaderboards_cache.npz"))
+	return UserStore(os.path.join(out_dir, "users")), scaled_store, scaled_payouts
+
+
+# Makes V1Simulation read its leaderboards and payouts from the given dataset
+@contextlib.contextmanager
+def use_dataset(store, payouts):
+	saved = V1Simulation.leaderboard_store, V1Simulation.competitions_to_payouts
+	V1Simulation.leaderboard_store, V1Simulation.competitions_to_payouts = store, payouts
+	try:
+		yield
+	finally:
+		V1Simulation.leaderboard_store, V1Simulation.competitions_to_payouts = saved
+
+
+# Calls fn repeat times and returns the wall clock time of every call
+def time_call(fn, repeat):
+	seconds = []
+	for _ in range(repeat):
+		start = time.perf_counter()
+		# The simulation reports its results as it goes
+		with contextlib.redirect_stdout(io.StringIO()): fn()
+		seconds.append(time.perf_counter() - start)
+
+	return {"seconds": seconds, "min": min(seconds), "median": float(np.median(seconds))}
+
+
+# Runs every benchmark on one dataset
+def run_benchmarks(users, store, payouts, gold_competition, args):
+	user_info = users.user_info()
+	competition_names = store.competition_names()
+	normal_competition_names = [name for name in competition_names if name != gold_competition]
+	num_retained = V1Simulation.num_retained
+
+	# Inputs of allocate_eliminated and compute_gains, built as in perform_simulation
+	gold_competitors_info = V1Simulation.get_competitors(gold_competition, user_info)
+	eliminated_info = gold_competitors_info[num_retained:]
+	normal_competitors = {name: V1Simulation.get_competitors(name, user_info) for name in normal_competition_names}
+	normal_payouts = [payouts[name] for name in normal_competition_names]
+	probabilities = [payout / sum(normal_payouts) for payout in normal_payouts]
+	rng = np.random.default_rng(args.seed)
+	after = V1Simulation.allocate_eliminated(eliminated_info, normal_competition_names, probabilities,\
+											normal_competitors, num_retained, rng=rng)
+
+	sweep_args = argparse.Namespace(plot=False, save=False, limit_entries=args.limit_entries, analytic=False,\
+									tolerance=None, max_iterations=args.iterations, common_random_numbers=False,\
+									workers=1, seed=args.seed)
+
+	benchmarks = {
+		"get_competitors": (lambda: V1Simulation.get_competitors(gold_competition, user_info), args.repeat),
+		"allocate_eliminated": (lambda: V1Simulation.allocate_eliminated(eliminated_info, normal_competition_names,\
+									probabilities, normal_competitors, num_retained, args.limit_entries, rng), args.repeat),
+		"compute_gains": (lambda: V1Simulation.compute_gains(normal_competitors, after, user_info, num_retained), args.repeat),
+		"perform_simulation": (lambda: V1Simulation.perform_simulation(users, gold_competition, normal_competition_names,\
+									num_retained, False, False, limit_entries=args.limit_entries, rng=rng,\
+									max_iterations=args.iterations), args.repeat),
+		"find_best_num_retained": (lambda: V1Simulation.sweep_num_retained(users, gold_competition,\
+									normal_competition_names, sweep_args), 1),
+	}
+
+	results = {}
+	for name, (fn, repeat) in benchmarks.items():
+		if args.only and name not in args.only: continue
+		results[name] = time_call(fn, repeat)
+		print ("  " + name + ": " + str(round(results[name]["median"], 4)) + " s")
+
+	return results
+
+
+# Rough peak memory of the simulation in bytes: the user index (names and
+# mappings from name to ID and to (tier, points)) plus the chunked
+# per-iteration arrays, which are bounded independently of the data size
+def estimate_memory(num_users, num_competitions):
+	return num_users * 400 + num_competitions * 2 ** 16 + 2 ** 29
+
+
+# Prints the ratio of every median time to the same median in the baseline report
+def compare(report, baseline_path):
+	with open(baseline_path, 'r') as f: baseline = json.load(f)
+	baseline_benchmarks = {dataset_label(dataset): dataset.get("benchmarks", {}) for dataset in baseline["datasets"]}
+
+	print ("Median time relative to " + baseline_path + ":")
+	for dataset in report["datasets"]:
+		for name, timing in dataset.get("benchmarks", {}).items():
+			before = baseline_benchmarks.get(dataset_label(dataset), {}).get(name)
+			if before is None: continue
+			print ("  " + dataset_label(dataset) + " " + name + ": " + str(round(timing["median"] / before["median"], 2)) + "x")
+
+
+# Scaled copies of the shipped data are labelled by their scale, synthetic datasets by their directory
+def dataset_label(dataset):
+	return "scale " + str(dataset["scale"]) if "scale" in dataset else dataset["dataset"]
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--scales", help="factors to scale the number of users and competitions by (1 is the shipped data)", type=int, nargs='+', default=[1, 10])
+	parser.add_argument("--repeat", help="number of timed calls of every benchmark except the sweep", type=int, default=5)
+	parser.add_argument("--iterations", help="number of allocations drawn by every simulation", type=int, default=100)
+	parser.add_argument("-l", "--limit_entries", help="benchmark with limited entries, see V1Simulation", action="store_true")
+	parser.add_argument("--datasets", help="directories written by SyntheticData.py to benchmark as well", nargs='+', default=[])
+	parser.add_argument("--only", help="names of the benchmarks to run", nargs='+', default=None)
+	parser.add_argument("--max_memory", help="skip scales estimated to need more than this many GB", type=float, default=2.)
+	parser.add_argument("--seed", help="seed for the random allocations", type=int, default=0)
+	parser.add_argument("--output", help="JSON file to write the timings to", default="benchmark.json")
+	parser.add_argument("--baseline", help="JSON file written by an earlier run to compare against", default=None)
+	args = parser.parse_args()
+
+	users = load_user_store("kaggle_users_store", "kaggle_users.npy")
+	store = V1Simulation.get_leaderboard_store()
+
+	report = {
+		"created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+		"python": platform.python_version(),
+		"numpy": np.__version__,
+		"machine": platform.machine(),
+		"args": vars(args),
+		"datasets": [],
+	}
+
+	for scale in args.scales:
+		num_users, num_competitions = len(users) * scale, len(store.competition_names()) * scale
+		dataset = {"scale": scale, "num_users": num_users, "num_competitions": num_competitions}
+		report["datasets"].append(dataset)
+		print ("Scale " + str(scale) + ": " + str(num_users) + " users, " + str(num_competitions) + " competitions")
+
+		if estimate_memory(num_users, num_competitions) > args.max_memory * 2 ** 30:
+			dataset["skipped"] = "estimated to need more than " + str(args.max_memory) + " GB"
+			print ("  skipped, " + dataset["skipped"])
+			continue
+
+		if scale == 1:
+			dataset["benchmarks"] = run_benchmarks(users, store, V1Simulation.competitions_to_payouts, gold_competition, args)
+			continue
+
+		out_dir = tempfile.mkdtemp(prefix="benchmark_")
+		try:
+			start = time.perf_counter()
+			scaled_users, scaled_store, scaled_payouts = write_scaled_dataset(users, store, scale, out_dir,\
+																			V1Simulation.competitions_to_payouts)
+			dataset["setup_seconds"] = time.perf_counter() - start
+			with use_dataset(scaled_store, scaled_payouts):
+				dataset["benchmarks"] = run_benchmarks(scaled_users, scaled_store, scaled_payouts, gold_competition, args)
+		finally:
+			shutil.rmtree(out_dir)
+
+	for dataset_dir in args.datasets:
+		synthetic_users, synthetic_store, synthetic_payouts, synthetic_gold = load_synthetic_dataset(dataset_dir)
+		num_users, num_competitions = len(synthetic_users), len(synthetic_store.competition_names())
+		dataset = {"dataset": dataset_dir, "num_users": num_users, "num_competitions": num_competitions}
+		report["datasets"].append(dataset)
+		print ("Dataset " + dataset_dir + ": " + str(num_users) + " users, " + str(num_competitions) + " competitions")
+
+		if estimate_memory(num_users, num_competitions) > args.max_memory * 2 ** 30:
+			dataset["skipped"] = "estimated to need more than " + str(args.max_memory) + " GB"
+			print ("  skipped, " + dataset["skipped"])
+			continue
+
+		with use_dataset(synthetic_store, synthetic_payouts):
+			dataset["benchmarks"] = run_benchmarks(synthetic_users, synthetic_store, synthetic_payouts, synthetic_gold, args)
+
+	with open(args.output, 'w') as f: json.dump(report, f, indent=1)
+	print ("Wrote timings to " + args.output)
+
+	if args.baseline is not None: compare(report, args.baseline)
+
+
+if __name__ == "__main__":
+	main()
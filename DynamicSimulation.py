@@ -0,0 +1,152 @@
+'''
+Multi-round version of the reallocation simulation.
+
+Every round is one competition season run on the same competitions.
+The gold competition keeps its top num_retained users by their current
+points, the rest are reallocated to the normal competitions as in
+perform_simulation, and every competition then awards points by
+finishing position using Kaggle's formula
+	100000 * rank ** -0.75 * log10(1 + log10(number of teams))
+Finishing positions are drawn from the users' current points with some
+noise. Existing points decay between seasons, and users whose points
+rise past a promotion threshold move up a tier (tiers are never lowered).
+The gold cut therefore changes from round to round.
+
+Welfare is computed as in compute_welfare (the sum of the top
+num_retained points of a competition) and the users start out with
+the tiers and points of get_user_info. All state lives in arrays
+allocated once up front, and the metrics of every round are streamed
+to disk as soon as the round finishes:
+	rounds.csv -- one row of summary metrics per round
+	gains.npy  -- welfare gain of every normal competition in every round
+'''
+
+import csv
+import os
+import numpy as np
+from numpy.lib.format import open_memmap
+from SimulationEngine import BaselineState, simulate_gains
+from UserStore import TIERS, TIER_CODES
+
+# Points decay as exp(-days / 500) on Kaggle, and a season lasts about 90 days
+season_decay = float(np.exp(-90 / 500.))
+
+
+# Points awarded to the user finishing at rank (1 is best) among num_teams teams
+def kaggle_points(rank, num_teams):
+	return 100000. * rank ** -0.75 * np.log10(1. + np.log10(max(num_teams, 1)))
+
+
+class DynamicSimulation(object):
+	# points and tiers hold the starting state of every user (indexed by ID)
+	# gold_ids and competitor_ids hold the IDs of the users in the gold and in
+	# every normal competition, and num_teams the size of every leaderboard
+	# (gold first) including entrants that are not ranked users.
+	# thresholds maps a tier code to the points needed to be promoted to it, by
+	# default the median points of the users that start out in that tier.
+	def __init__(self, points, tiers, gold_ids, competitor_ids, num_teams, probabilities, num_retained,\
+				limit_entries=False, decay=season_decay, noise=0.5, thresholds=None, rng=None):
+		# Per-user state, updated in place every round
+		self.points = np.array(points, dtype=np.float64)
+		self.tiers = np.array(tiers, dtype=np.uint8)
+		self.awards = np.zeros(len(self.points))
+		self.previous_points = np.zeros(len(self.points))
+
+		self.gold_ids = np.asarray(gold_ids, dtype=np.intp)
+		self.competitor_ids = [np.asarray(ids, dtype=np.intp) for ids in competitor_ids]
+		self.num_teams = list(num_teams)
+		self.probabilities = probabilities
+		self.num_retained = num_retained
+		self.limit_entries = limit_entries
+		self.decay = decay
+		self.noise = noise
+		self.rng = rng if rng is not None else np.random.default_rng()
+
+		if thresholds is None:
+			thresholds = {}
+			for tier in ("master", "grandmaster"):
+				in_tier = self.points[self.tiers == TIER_CODES[tier]]
+				if len(in_tier): thresholds[TIER_CODES[tier]] = float(np.median(in_tier))
+		# Checked from the lowest to the highest tier, so users can skip tiers
+		self.thresholds = sorted(thresholds.items())
+
+
+	# Ranks the entrants of a competition by noisy performance and adds their points to awards
+	def award_points(self, entrants, num_teams):
+		if len(entrants) == 0: return
+		performance = np.log1p(self.points[entrants]) + self.noise * self.rng.standard_normal(len(entrants))
+		order = np.argsort(-performance, kind="stable")
+		ranks = np.arange(1, len(entrants) + 1, dtype=np.float64)
+		self.awards[entrants[order]] += kaggle_points(ranks, max(num_teams, len(entrants)))
+
+
+	# Runs one season and returns (metrics, gains) where gains holds
+	# the welfare gain of every normal competition
+	def step(self):
+		# The gold competition retains its best users by current points,
+		# ties broken by ID so the cut does not depend on the input order
+		gold_order = np.lexsort((self.gold_ids, -self.points[self.gold_ids]))
+		ranked_gold = self.gold_ids[gold_order]
+		retained, eliminated = ranked_gold[:self.num_retained], ranked_gold[self.num_retained:]
+		gold_cut = float(self.points[retained[-1]]) if len(retained) else 0.
+
+		baseline = BaselineState(self.points, self.competitor_ids, eliminated, self.num_retained)
+		gains, assignments = simulate_gains(baseline, self.probabilities, 1, self.limit_entries, self.rng)
+		added = assignments[0].T & ~baseline.present
+
+		# Every competition awards points by finishing position
+		self.awards[:] = 0.
+		self.award_points(retained, min(self.num_teams[0], len(retained)))
+		for comp_idx, ids in enumerate(self.competitor_ids):
+			new_entrants = eliminated[added[comp_idx]]
+			self.award_points(np.concatenate((ids, new_entrants)), self.num_teams[comp_idx + 1] + len(new_entrants))
+
+		np.copyto(self.previous_points, self.points)
+		self.points *= self.decay
+		self.points += self.awards
+
+		# Users are promoted when their points rise past a threshold, and never demoted
+		promotions = 0
+		for code, threshold in self.thresholds:
+			promoted = (self.points >= threshold) & (self.previous_points < threshold) & (self.tiers < code)
+			promotions += int(promoted.sum())
+			self.tiers[promoted] = code
+
+		metrics = {
+			"gold_cut": gold_cut,
+			"num_eliminated": len(eliminated),
+			"num_added": int(added.sum()),
+			"total_gain": float(gains[0].sum()),
+			"mean_points": float(self.points.mean()),
+			"promotions": promotions,
+		}
+		tier_counts = np.bincount(self.tiers, minlength=len(TIERS))
+		for code, tier in enumerate(TIERS): metrics["num_" + tier] = int(tier_counts[code])
+
+		return metrics, gains[0]
+
+
+	# Runs num_rounds seasons, writing rounds.csv and gains.npy to out_dir as it goes
+	def run(self, num_rounds, out_dir, report_every=100):
+		if not os.path.isdir(out_dir): os.mkdir(out_dir)
+		gains = open_memmap(os.path.join(out_dir, "gains.npy"), mode='w+', dtype=np.float64,\
+							shape=(num_rounds, len(self.competitor_ids)))
+
+		with open(os.path.join(out_dir, "rounds.csv"), 'w', newline='') as f:
+			writer = None
+			for round_idx in range(num_rounds):
+				metrics, gains[round_idx] = self.step()
+				metrics = dict(round=round_idx, **metrics)
+
+				if writer is None:
+					writer = csv.DictWriter(f, fieldnames=list(metrics.keys()))
+					writer.writeheader()
+				writer.writerow(metrics)
+				f.flush()
+
+				if report_every and (round_idx + 1) % report_every == 0:
+					print ("Round " + str(round_idx + 1) + ": gold cut " + str(round(metrics["gold_cut"], 1))\
+							+ ", total gain " + str(round(metrics["total_gain"], 1)))
+
+		gains.flush()
+		del gains
@@ -0,0 +1,135 @@
+'''
+Loads the public leaderboards once and keeps the usernames of every
+competition in memory. Leaderboards are read straight out of the
+archives in Leaderboards_zip (a directory of extracted CSVs works
+too), so nothing is ever extracted to disk. Parsed leaderboards are
+also cached on disk in a compact .npz file keyed by each file's
+modification time and size, so repeated runs do not have to parse
+any CSVs at all.
+'''
+
+import csv
+import io
+import json
+import os
+import zipfile
+import numpy as np
+
+
+class LeaderboardStore(object):
+	def __init__(self, leaderboards_dir="Leaderboards_zip", cache_path="leaderboards_cache.npz"):
+		self.leaderboards_dir = leaderboards_dir
+		self.cache_path = cache_path
+
+		# Mapping from competition name to array of unique usernames
+		self.competitors = {}
+		self.load()
+
+
+	# Competition name for a leaderboard file name
+	@staticmethod
+	def competition_name(fname):
+		return "-".join(fname.split('.')[0].split('-')[:-1])
+
+
+	# (file name, zip member, mtime, size) of every leaderboard, keyed by
+	# competition name. The zip member is None for plain CSV files.
+	def file_stamps(self):
+		result = {}
+		for fname in sorted(os.listdir(self.leaderboards_dir)):
+			path = os.path.join(self.leaderboards_dir, fname)
+			stat = os.stat(path)
+
+			if fname.endswith(".zip"):
+				with zipfile.ZipFile(path, 'r') as zip_ref:
+					for member in zip_ref.namelist():
+						if not member.endswith(".csv") or member.startswith("__MACOSX"): continue
+						result[self.competition_name(os.path.basename(member))] = (fname, member, stat.st_mtime_ns, stat.st_size)
+			elif fname.endswith(".csv"):
+				result[self.competition_name(fname)] = (fname, None, stat.st_mtime_ns, stat.st_size)
+
+		return result
+
+
+	# Reads only the username column of a leaderboard, one row at a time
+	# NOTE: the leaderboards start with a byte order mark
+	def parse_leaderboard(self, fname, member=None):
+		path = os.path.join(self.leaderboards_dir, fname)
+
+		if member is None: return self.parse_usernames(open(path, 'r', newline='', encoding="utf-8-sig"))
+
+		with zipfile.ZipFile(path, 'r') as zip_ref:
+			return self.parse_usernames(io.TextIOWrapper(zip_ref.open(member, 'r'), newline='', encoding="utf-8-sig"))
+
+
+	@staticmethod
+	def parse_usernames(f):
+		with f:
+			reader = csv.reader(f)
+			next(reader, None)
+			names = set(row[1] for row in reader if len(row) > 1)
+		return np.array(sorted(names), dtype=str)
+
+
+	# Loads every leaderboard, only parsing those whose
+	# CSV changed since the disk cache was written
+	def load(self):
+		stamps = self.file_stamps()
+		cached_stamps, cached_competitors = self.read_cache()
+
+		changed = False
+		for competition, stamp in stamps.items():
+			if cached_stamps.get(competition) == list(stamp):
+				self.competitors[competition] = cached_competitors[competition]
+			else:
+				self.competitors[competition] = self.parse_leaderboard(stamp[0], stamp[1])
+				changed = True
+
+		if changed or len(cached_stamps) != len(stamps): self.write_cache(stamps)
+
+
+	def read_cache(self):
+		if not os.path.isfile(self.cache_path): return {}, {}
+
+		try:
+			with np.load(self.cache_path, allow_pickle=False) as cache:
+				stamps = json.loads(str(cache["stamps"]))
+				names = cache["names"]
+				offsets = cache["offsets"]
+		except (OSError, ValueError, KeyError):
+			return {}, {}
+
+		competitors = {}
+		for idx, competition in enumerate(stamps.keys()):
+			competitors[competition] = names[offsets[idx]:offsets[idx + 1]]
+		return stamps, competitors
+
+
+	# All usernames are stored in one array, with offsets
+	# marking where each competition's usernames start
+	def write_cache(self, stamps):
+		competitions = list(stamps.keys())
+		offsets = np.cumsum([0] + [len(self.competitors[comp]) for comp in competitions])
+		names = np.concatenate([self.competitors[comp] for comp in competitions]) if competitions else np.array([], dtype=str)
+
+		# The cache is only an optimization; running from a
+		# read-only location simply skips writing it
+		try:
+			np.savez_compressed(self.cache_path, names=names, offsets=offsets,\
+					stamps=np.array(json.dumps(stamps)))
+		except OSError:
+			pass
+
+
+	def competition_names(self):
+		return list(self.competitors.keys())
+
+
+	def usernames(self, competition):
+		return self.competitors[competition]
+
+
+	# Integer IDs of the users in a competition that appear in name_to_id
+	def competitor_ids(self, competition, name_to_id):
+		ids = [name_to_id[name] for name in self.competitors[competition] if name in name_to_id]
+		return np.array(ids, dtype=np.intp)
@@ -0,0 +1,139 @@
+'''
+Deferred rendering of the simulation's figures.
+
+The plotting functions in V1Simulation only collect what to draw into a
+PlotQueue. The queue is rendered once the simulation is done: saved
+figures are drawn on the headless Agg backend (optionally spread over
+worker processes) and every figure is closed as soon as it has been
+saved or shown, so memory stays flat however many plots are made.
+'''
+
+import numpy as np
+
+
+class PlotQueue(object):
+	def __init__(self):
+		# (kind, filename, data) for every figure, see RENDERERS
+		self.specs = []
+
+
+	def __len__(self):
+		return len(self.specs)
+
+
+	def add(self, kind, filename, **data):
+		self.specs.append((kind, filename, data))
+
+
+	def extend(self, specs):
+		self.specs.extend(specs)
+
+
+	# Renders and clears the queue. Saved figures can be rendered by
+	# several worker processes, shown figures are always rendered here.
+	def render(self, save_plots, workers=1):
+		if save_plots and workers > 1 and len(self.specs) > 1:
+			from concurrent.futures import ProcessPoolExecutor
+			with ProcessPoolExecutor(max_workers=workers) as executor:
+				list(executor.map(render_saved, self.specs))
+		else:
+			for spec in self.specs: render_spec(spec, save_plots)
+
+		self.specs = []
+
+
+# matplotlib is only imported once something is rendered
+def get_pyplot(headless):
+	import matplotlib
+	if headless: matplotlib.use("Agg")
+	from matplotlib import pyplot as plt
+	return plt
+
+
+def render_spec(spec, save_plots):
+	kind, filename, data = spec
+	plt = get_pyplot(headless=save_plots)
+
+	fig = plt.figure(figsize=(12.5, 7.5))
+	RENDERERS[kind](plt, **data)
+
+	if save_plots: fig.savefig(filename, dpi=fig.dpi)
+	else: plt.show()
+	plt.close(fig)
+
+
+def render_saved(spec):
+	render_spec(spec, True)
+
+
+def render_category_histogram(plt, frequencies, title):
+	categories = ('Grandmasters', 'Masters', 'Experts')
+	y_pos = np.arange(len(categories))
+	plt.bar(y_pos, frequencies, align='center', alpha=0.5)
+	plt.xticks(y_pos, categories)
+	plt.ylabel('Number of competitors')
+	plt.xlabel('Competitor category')
+	plt.title(title)
+
+
+def render_payout_category_bars(plt, grandmasters, masters, experts, title,\
+								labels=('0 to 25K', '25K to 50K', '50K to 75K', '75K to 100K')):
+	ind = np.arange(len(grandmasters))
+	bars = [masters[idx] + experts[idx] for idx in range(len(grandmasters))]
+
+	p1 = plt.bar(ind, experts)
+	p2 = plt.bar(ind, masters, bottom = experts)
+	p3 = plt.bar(ind, grandmasters, bottom = bars)
+
+	plt.ylabel('Average Number of Participants')
+	plt.title(title)
+
+	plt.xticks(ind, labels)
+	plt.xlabel('Total Competition Payout ($)')
+	plt.legend((p1[0], p2[0], p3[0]), ('Experts', 'Masters', 'Grandmasters'))
+
+
+# This just plots the orange part of render_point_gains
+def render_point_gains_simple(plt, r, bars, bar_width, names):
+	plt.bar(r, bars, edgecolor='white', width=bar_width)
+
+	# Custom X axis
+	plt.xticks(r, names, fontweight='bold')
+	plt.xlabel("Competition")
+
+	#Custom Y axis
+	plt.ylabel("Point gains")
+
+	plt.title("Points gained due to reallocation")
+
+
+def render_point_gains(plt, r, bars1, bars2, bar_width, names):
+	# Create brown bars
+	plt.bar(r, bars1, edgecolor='white', width=bar_width)
+	# Create green bars (middle), on top of the first ones
+	plt.bar(r, bars2, bottom=bars1, edgecolor='white', width=bar_width)
+
+	# Custom X axis
+	plt.xticks(r, names, fontweight='bold')
+	plt.xlabel("Competition")
+
+	#Custom Y axis
+	plt.ylabel("Points (Before:Blue and After:Orange)")
+
+	plt.title("Points gained due to reallocation")
+
+
+def render_best_num_retained(plt, x_vals, y_vals):
+	plt.plot(x_vals, y_vals)
+	plt.xlabel("Number of competitors in the gold competition")
+	plt.ylabel("Average gain after reallocation")
+	plt.title("Average gain vs. number retained in gold competition")
+
+
+RENDERERS = {
+	"category_histogram": render_category_histogram,
+	"payout_category_bars": render_payout_category_bars,
+	"point_gains_simple": render_point_gains_simple,
+	"point_gains": render_point_gains,
+	"best_num_retained": render_best_num_retained,
+}
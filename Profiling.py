@@ -0,0 +1,161 @@
+'''
+Opt-in phase timing for the simulation.
+
+Code marks its phases with
+	with phase("welfare"):
+		...
+which costs nothing unless a PhaseProfiler has been started. While one
+is running, every phase records its wall time and, if allocations are
+traced, the number of memory blocks and bytes it left allocated and
+the peak traced memory while it ran. Phases are grouped by scope, e.g.
+one scope per point of the num_retained sweep.
+
+Only the standard library is used: time, tracemalloc and, for whole
+program profiles, cProfile (see V1Simulation --profile).
+'''
+
+import contextlib
+import json
+import time
+import tracemalloc
+
+# Profilers that have been started and not stopped, innermost last
+active_profilers = []
+
+
+class PhaseProfiler(object):
+	def __init__(self, trace_allocations=False, scope_name=""):
+		self.trace_allocations = trace_allocations
+		self.started_tracing = False
+		self.scope_name = scope_name
+
+		# Totals keyed by (scope, phase), in the order phases first ran
+		self.records = {}
+		# Running peak traced memory of every open phase, innermost last
+		self.open_peaks = []
+
+
+	def start(self):
+		if self.trace_allocations and not tracemalloc.is_tracing():
+			tracemalloc.start()
+			self.started_tracing = True
+		active_profilers.append(self)
+		return self
+
+
+	def stop(self):
+		active_profilers.remove(self)
+		if self.started_tracing:
+			tracemalloc.stop()
+			self.started_tracing = False
+		return self
+
+
+	def record(self, scope, phase_name):
+		key = (scope, phase_name)
+		if key not in self.records:
+			self.records[key] = {"scope": scope, "phase": phase_name, "calls": 0, "seconds": 0.}
+			if self.trace_allocations: self.records[key].update(blocks=0, bytes=0, peak_bytes=0)
+		return self.records[key]
+
+
+	# Number of traced blocks and bytes currently allocated
+	@staticmethod
+	def traced_blocks():
+		snapshot = tracemalloc.take_snapshot()
+		return len(snapshot.traces), tracemalloc.get_traced_memory()[0]
+
+
+	@contextlib.contextmanager
+	def phase(self, phase_name):
+		record = self.record(self.scope_name, phase_name)
+		if self.trace_allocations:
+			fold_peak()
+			self.open_peaks.append(0)
+			blocks_before, bytes_before = self.traced_blocks()
+
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			record["seconds"] += time.perf_counter() - start
+			record["calls"] += 1
+
+			if self.trace_allocations:
+				fold_peak()
+				blocks_after, bytes_after = self.traced_blocks()
+				record["blocks"] += blocks_after - blocks_before
+				record["bytes"] += bytes_after - bytes_before
+				record["peak_bytes"] = max(record["peak_bytes"], self.open_peaks.pop())
+
+
+	# Every phase run inside this is recorded under the given scope
+	@contextlib.contextmanager
+	def scope(self, scope_name):
+		outer, self.scope_name = self.scope_name, scope_name
+		try:
+			yield
+		finally:
+			self.scope_name = outer
+
+
+	# Adds the records of a profiler that ran elsewhere, e.g. in a worker process
+	def merge(self, records):
+		for other in records:
+			record = self.record(other["scope"], other["phase"])
+			for field, value in other.items():
+				if field == "peak_bytes": record[field] = max(record[field], value)
+				elif field not in ("scope", "phase"): record[field] = record.get(field, 0) + value
+
+
+	def report(self):
+		return list(self.records.values())
+
+
+	# Prints the records of every scope, slowest phase first
+	def print_report(self):
+		scopes = []
+		for record in self.records.values():
+			if record["scope"] not in scopes: scopes.append(record["scope"])
+
+		for scope_name in scopes:
+			print ("Profile" + (" of " + scope_name if scope_name else "") + ":")
+			records = [record for record in self.records.values() if record["scope"] == scope_name]
+			for record in sorted(records, key=lambda x: -x["seconds"]):
+				line = "  " + record["phase"].ljust(16) + str(round(record["seconds"], 4)).rjust(10) + " s in "\
+						+ str(record["calls"]) + " calls"
+				if "blocks" in record:
+					line += ", " + str(record["blocks"]) + " blocks / " + str(record["bytes"]) + " bytes kept, peak "\
+							+ str(record["peak_bytes"]) + " bytes"
+				print (line)
+
+
+	# Writes the records, plus the top allocation sites if allocations are traced, as JSON
+	def write_report(self, path, top_sites=25):
+		report = {"phases": self.report()}
+		if self.trace_allocations and tracemalloc.is_tracing():
+			stats = tracemalloc.take_snapshot().statistics("lineno")[:top_sites]
+			report["allocation_sites"] = [{"site": str(stat.traceback), "blocks": stat.count, "bytes": stat.size}\
+											for stat in stats]
+
+		with open(path, 'w') as f: json.dump(report, f, indent=1)
+
+
+# Folds the peak traced memory since the last reset into every open phase
+# of every running profiler, then resets it
+def fold_peak():
+	peak = tracemalloc.get_traced_memory()[1]
+	for profiler in active_profilers:
+		profiler.open_peaks = [max(open_peak, peak) for open_peak in profiler.open_peaks]
+	tracemalloc.reset_peak()
+
+
+# Innermost running profiler, or None
+def current_profiler():
+	return active_profilers[-1] if active_profilers else None
+
+
+# Records the enclosed code as a phase of the innermost running profiler, if any
+def phase(phase_name):
+	if not active_profilers: return contextlib.nullcontext()
+	return active_profilers[-1].phase(phase_name)
@@ -0,0 +1,124 @@
+'''
+Content-addressed on-disk cache of simulation results.
+
+Every entry is a directory named after the SHA-256 of everything the
+result depends on: a fingerprint of the user data and leaderboards,
+the gold competition, num_retained, the number of allocations, the
+probabilities and the seed. It holds one .npy file per array of the
+SimulationResult plus a small meta.json, and arrays are memory-mapped
+when read. Entries are written to a temporary directory and renamed
+into place, so concurrent workers never see half-written entries.
+
+The cache is bounded in size: whenever an entry is added, the least
+recently used entries are evicted until the cache fits in max_bytes.
+Reading an entry marks it as used.
+'''
+
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+from SimulationEngine import SimulationResult
+from UserStore import COLUMNS
+
+# Arrays of a SimulationResult, of which all but the first two are optional
+ARRAYS = ("before_welfare", "gains", "half_widths", "gold_frequencies", "frequencies_before", "frequencies_after",\
+			"iteration_frequencies")
+
+
+# SHA-256 of the user store columns and of the usernames of every leaderboard
+def dataset_fingerprint(users, store):
+	digest = hashlib.sha256()
+	for column in COLUMNS: digest.update(np.ascontiguousarray(users.columns[column]).tobytes())
+	for competition in sorted(store.competition_names()):
+		digest.update(competition.encode("utf-8") + b"\0")
+		digest.update("\n".join(store.usernames(competition)).encode("utf-8") + b"\0")
+	return digest.hexdigest()
+
+
+class ResultCache(object):
+	def __init__(self, cache_dir="simulation_cache", max_bytes=256 * 2 ** 20):
+		self.cache_dir = cache_dir
+		self.max_bytes = max_bytes
+		if not os.path.isdir(cache_dir): os.makedirs(cache_dir, exist_ok=True)
+
+
+	# Key of a configuration given as JSON-serializable keyword arguments
+	@staticmethod
+	def key(**config):
+		return hashlib.sha256(json.dumps(config, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+	def entry_dir(self, key):
+		return os.path.join(self.cache_dir, key)
+
+
+	# Returns the cached SimulationResult for key, or None
+	def get(self, key):
+		entry_dir = self.entry_dir(key)
+		meta_path = os.path.join(entry_dir, "meta.json")
+		try:
+			with open(meta_path, 'r') as f: meta = json.load(f)
+			arrays = {name: np.load(os.path.join(entry_dir, name + ".npy"), mmap_mode='r', allow_pickle=False)\
+						for name in meta["arrays"]}
+			# Mark the entry as recently used
+			os.utime(meta_path)
+		except (OSError, ValueError, KeyError):
+			return None
+
+		return SimulationResult(meta["gold_competition"], meta["competitions"], meta["num_retained"],\
+								arrays["before_welfare"], arrays["gains"], half_widths=arrays.get("half_widths"),\
+								num_iterations=meta["num_iterations"], gold_frequencies=arrays.get("gold_frequencies"),\
+								frequencies_before=arrays.get("frequencies_before"),\
+								frequencies_after=arrays.get("frequencies_after"),\
+								iteration_frequencies=arrays.get("iteration_frequencies"))
+
+
+	def put(self, key, result):
+		arrays = [name for name in ARRAYS if getattr(result, name) is not None]
+		meta = {"gold_competition": result.gold_competition, "competitions": result.competitions,\
+				"num_retained": int(result.num_retained), "arrays": arrays,\
+				"num_iterations": int(result.num_iterations) if result.num_iterations is not None else None}
+
+		# The cache is only an optimization, so failing to write it is not an error
+		import tempfile
+		tmp_dir = None
+		try:
+			tmp_dir = tempfile.mkdtemp(prefix=".tmp_", dir=self.cache_dir)
+			for name in arrays: np.save(os.path.join(tmp_dir, name + ".npy"), np.asarray(getattr(result, name)))
+			with open(os.path.join(tmp_dir, "meta.json"), 'w') as f: json.dump(meta, f)
+
+			entry_dir = self.entry_dir(key)
+			if os.path.isdir(entry_dir): shutil.rmtree(entry_dir, ignore_errors=True)
+			os.rename(tmp_dir, entry_dir)
+		except OSError:
+			if tmp_dir is not None: shutil.rmtree(tmp_dir, ignore_errors=True)
+			return
+
+		self.evict()
+
+
+	# (last used, size in bytes, path) of every entry
+	def entries(self):
+		result = []
+		for name in os.listdir(self.cache_dir):
+			entry_dir = os.path.join(self.cache_dir, name)
+			if name.startswith(".tmp_") or not os.path.isdir(entry_dir): continue
+			try:
+				last_used = os.stat(os.path.join(entry_dir, "meta.json")).st_mtime
+				size = sum(os.path.getsize(os.path.join(entry_dir, fname)) for fname in os.listdir(entry_dir))
+			except OSError:
+				continue
+			result.append((last_used, size, entry_dir))
+		return result
+
+
+	# Removes the least recently used entries until the cache fits in max_bytes
+	def evict(self):
+		entries = sorted(self.entries())
+		total = sum(entry[1] for entry in entries)
+		for last_used, size, entry_dir in entries:
+			if total <= self.max_bytes: break
+			shutil.rmtree(entry_dir, ignore_errors=True)
+			total -= size
@@ -0,0 +1,122 @@
+'''
+Generalized competition structures for the reallocation simulation.
+
+A scenario picks any number of "gold" competitions, each with its own
+cap on the number of users it retains, and the payouts of every
+competition. Users eliminated from any gold competition are reallocated
+to the normal competitions with probabilities proportional to payout.
+
+evaluate_scenarios evaluates a whole batch of scenarios in one vectorized
+pass. All scenarios share the same random draws, so differences between
+them are not swamped by sampling noise.
+'''
+
+import numpy as np
+from SimulationEngine import sample_entries, top_k_values
+
+
+class Scenario(object):
+	# gold_caps maps every gold competition to the number of users it retains
+	# payouts maps every competition to its payout
+	# welfare_top is the number of top competitors that count towards the
+	# welfare of a competition, by default the largest gold cap
+	def __init__(self, gold_caps, payouts, welfare_top=None, name=None):
+		self.gold_caps = dict(gold_caps)
+		self.payouts = dict(payouts)
+		self.welfare_top = welfare_top if welfare_top is not None else max(self.gold_caps.values())
+		self.name = name
+
+
+	def normal_competitions(self, competitions):
+		return [competition for competition in competitions if competition not in self.gold_caps]
+
+
+	# Probability of choosing each competition, 0 for gold competitions
+	def probabilities(self, competitions):
+		payouts = np.array([0. if competition in self.gold_caps else self.payouts[competition]\
+							for competition in competitions])
+		return payouts / payouts.sum()
+
+
+# Sums of the top j entries along the last axis for j = 0..k
+def top_k_prefix_sums(values, k):
+	top = -np.sort(-top_k_values(values, k), axis=-1)
+	zeros = np.zeros(values.shape[:-1] + (1,))
+	return np.concatenate((zeros, np.cumsum(top, axis=-1)), axis=-1)
+
+
+# Mean welfare gain of every competition under every scenario, as an array of
+# shape (scenarios, competitions) holding NaN for each scenario's gold competitions.
+#
+# membership[c, u] is True if user u competes in competition c and
+# ranked_ids[c] holds the IDs of competition c's users from most to least points,
+# so a gold competition with cap n eliminates ranked_ids[c][n:].
+def evaluate_scenarios(points, membership, ranked_ids, competitions, scenarios, num_iterations=100,\
+						limit_entries=False, rng=None, max_chunk_elements=1 << 24):
+	num_scenarios, num_comps = len(scenarios), len(competitions)
+	comp_index = {competition: idx for idx, competition in enumerate(competitions)}
+
+	is_gold = np.zeros((num_scenarios, num_comps), dtype=bool)
+	caps = np.zeros((num_scenarios, num_comps), dtype=np.intp)
+	probabilities = np.zeros((num_scenarios, num_comps))
+	welfare_top = np.array([scenario.welfare_top for scenario in scenarios], dtype=np.intp)
+	for s, scenario in enumerate(scenarios):
+		for competition, cap in scenario.gold_caps.items():
+			is_gold[s, comp_index[competition]] = True
+			caps[s, comp_index[competition]] = cap
+		probabilities[s] = scenario.probabilities(competitions)
+
+	# Only users in some gold competition can ever be eliminated
+	gold_comps = np.flatnonzero(is_gold.any(axis=0))
+	candidates = np.unique(np.concatenate([ranked_ids[c] for c in gold_comps] + [np.zeros(0, dtype=np.intp)]))
+	local = np.full(len(points), -1, dtype=np.intp)
+	local[candidates] = np.arange(len(candidates))
+
+	eliminated = np.zeros((num_scenarios, len(candidates)), dtype=bool)
+	for s in range(num_scenarios):
+		for c in np.flatnonzero(is_gold[s]): eliminated[s, local[ranked_ids[c][caps[s, c]:]]] = True
+
+	# Users already in a competition cannot be added to it again
+	new_entrant = ~membership[:, candidates]
+	candidate_points = points[candidates]
+
+	max_top = int(welfare_top.max(initial=0))
+	baseline_top = top_k_values(np.where(membership, points, 0.0), max_top)
+	before = np.take_along_axis(top_k_prefix_sums(baseline_top, max_top)[None],\
+								welfare_top[:, None, None], axis=-1)[..., 0]
+
+	# Draws shared by every scenario
+	draws = None
+	if limit_entries:
+		if rng is None: rng = np.random.default_rng()
+		draws = rng.random((num_iterations, len(candidates), num_comps + 1))
+
+	gains = np.full((num_scenarios, num_comps), np.nan)
+	per_scenario = max(num_iterations * len(candidates) * (num_comps + max_top), 1)
+	chunk_size = max(1, max_chunk_elements // per_scenario)
+
+	for start in range(0, num_scenarios, chunk_size):
+		chunk = slice(start, min(start + chunk_size, num_scenarios))
+		num_chunk = chunk.stop - chunk.start
+
+		if limit_entries:
+			# Same weighted sampling without replacement as draw_assignments, where
+			# every scenario enters between 1 and half of its normal competitions
+			max_entries = np.maximum((~is_gold[chunk]).sum(axis=1) // 2, 1)
+			assigned = sample_entries(draws[None], probabilities[chunk, None, None, :], max_entries[:, None, None])\
+						.transpose(0, 1, 3, 2)
+		else:
+			assigned = np.ones((num_chunk, num_iterations, num_comps, len(candidates)), dtype=bool)
+
+		added = assigned & eliminated[chunk, None, None, :] & new_entrant[None, None]\
+				& ~is_gold[chunk, None, :, None]
+		added_values = np.where(added, candidate_points, 0.0)
+
+		values = np.concatenate((np.broadcast_to(baseline_top, (num_chunk, num_iterations) + baseline_top.shape),\
+								added_values), axis=-1)
+		after = np.take_along_axis(top_k_prefix_sums(values, max_top),\
+									welfare_top[chunk, None, None, None], axis=-1)[..., 0]
+		gains[chunk] = (after - before[chunk, None]).mean(axis=1)
+
+	gains[is_gold] = np.nan
+	return gains
@@ -11,9 +11,21 @@ from bs4 import BeautifulSoup
 import requests
 import json
 import numpy as np
-import time
 import os.path
+import asyncio
+import argparse
 from subprocess import call
+from AsyncFetcher import AsyncFetcher
+
+
+# Returns the list of users embedded in the script of a rankings page
+# The array is located with str.find and decoded in a single pass
+def extract_users(text, start=0):
+	array_start = text.find('[{"c', start)
+	if array_start < 0: return []
+
+	users, _ = json.JSONDecoder().raw_decode(text, array_start)
+	return users
 
 
 # First pass at scraping
@@ -25,57 +37,89 @@ def naively_scrape_html():
 	main_content_div = soup.find("div",  {"class": "site-layout__main-content"})
 	main_content_script = main_content_div.findChildren('script', recursive=False)[0]
 
-	text = main_content_script.text
-	str_to_load = "["
-	should_append = False
+	users = extract_users(main_content_script.text)
 
-	for char_idx in range(len(text)):
-		if text[char_idx: char_idx + 3] == '});': break
+	for user in users:
+		print(user["displayName"])
 
-		if should_append: 
-			str_to_load += text[char_idx]
-			continue
 
-		if text[char_idx: char_idx + 4] == '[{\"c': should_append = True
+# Extracts the users from saved rankings pages without parsing the HTML
+# paths can be a mix of HTML files and directories containing them
+def parse_saved_rankings(paths):
+	files = []
+	for path in paths:
+		if os.path.isdir(path): files += sorted(os.path.join(path, fname) for fname in os.listdir(path) if fname.endswith(".html"))
+		else: files.append(path)
 
-	users = json.loads(str_to_load)
+	users = []
+	for fname in files:
+		with open(fname, 'r', encoding="utf-8") as f: html = f.read()
 
-	for user in users:
-		print(user["displayName"])
+		# The users are in the script of the main content div
+		main_content = html.find("site-layout__main-content")
+		users += extract_users(html, max(main_content, 0))
 
+	return users
+
+
+
+# Path of one page of the competition rankings
+def rankings_path(page_counter):
+	return "/rankings.json?group=competitions&page=" + str(page_counter) + "&pageSize=20"
 
 
 # Note that we are only able to scrape expert, master, and grand master data
 # But probably not a big deal to ignore novice and contributor data
-def scrape_kaggle_user_data():
+async def scrape_kaggle_user_data_async(fetcher):
 	users = []
 	page_counter = 1
 
 	# Should be able to get to page 247
+	# Pages are requested in batches of the fetcher's concurrency
+	# until a batch runs past the last page
 	while(True):
-		# Make request
-		url = "https://www.kaggle.com/rankings.json?group=competitions&page=" + str(page_counter) + "&pageSize=20"
-		page = requests.get(url)
-		
-		# Parse user data from request
-		data = page.json()["list"]
-		if len(data) == 0: break
-		
-		# Add user data to list
-		users = users + data
+		pages = range(page_counter, page_counter + fetcher.max_concurrency)
+		responses = await fetcher.fetch_all([rankings_path(page) for page in pages])
+
+		done = False
+		for page, response in zip(pages, responses):
+			# fetch_json has already retried, so a missing page would
+			# silently truncate the rankings
+			if response is None: raise RuntimeError("Could not fetch page " + str(page) + " of the rankings")
+
+			# Parse user data from request
+			data = response["list"]
+			if len(data) == 0:
+				done = True
+				break
+
+			# Add user data to list
+			users = users + data
 
 		# Report progress
-		print ("Page counter is: " + str(page_counter))
+		page_counter += len(pages)
+		print ("Page counter is: " + str(page_counter - 1))
 		print ("Number of users so far is: " + str(len(users)))
-		
-		# Increment counter
-		page_counter += 1
 
-		# Pause so as not to upset API
-		time.sleep(0.1)
+		if done: break
+
+	return users
+
+
+def scrape_kaggle_user_data(fetcher=None):
+	if fetcher is None: fetcher = AsyncFetcher()
+	try:
+		users = asyncio.run(scrape_kaggle_user_data_async(fetcher))
+	finally:
+		fetcher.close()
 
 	np.save("kaggle_users", users)
-	return kaggle_users
+	return users
+
+
+# Path of the competitions a user has entered
+def competitions_path(user_url):
+	return user_url + "/competitions.json?sortBy=grouped&group=entered&page=1&pageSize=20"
 
 
 # Currently only used to find the LIVE competitions a user is
@@ -83,69 +127,118 @@ def scrape_kaggle_user_data():
 # However, would be necessary if finding ALL competitions a user
 # has participated in since some have participated in more than 20,
 # which is the page size of the API request.
-def get_competitions_data(user_url):
-	fail_count = 0
-
-	# loop in case response is malformed
-	while(True):
-		# Make request
-		url = "https://www.kaggle.com" + user_url + "/competitions.json?sortBy=grouped&group=entered&page=1&pageSize=20"
-		page = requests.get(url)
-
-		status_code = page.status_code
-		print("Response status code: " + str(status_code))
-
-		if status_code == 200: break
-		elif status_code == 429: 
-			fail_count += 1
-			time.sleep(min(fail_count * 60, 180))
-
-	# Pause so as not to upset API
-	time.sleep(5 * np.random.rand() + 10)
-
+def parse_competitions_data(response):
 	# Parse LIVE competition data from response
 	# This will be in the form of a list of length k
 	# Each item in the list is JSON for a given live competition
 	try:
-		result = page.json()["fullCompetitionGroups"][0]["competitions"]
-		return result
-	except:
+		return response["fullCompetitionGroups"][0]["competitions"]
+	except (TypeError, KeyError, IndexError):
 		print("Error parsing JSON")
 		return []
 
 
-def get_user_id_to_competitions(user_data):
+# Reads the append-only checkpoint log written by get_user_id_to_competitions
+# Each line is a JSON object {"userId": ..., "competitions": [...]}
+def read_checkpoint(checkpoint_path):
 	result = {}
-	num_completed = 0
-
-	for user in user_data:
-		user_url = user["userUrl"]
-		competitions_data = get_competitions_data(user_url)
-		result[user["userId"]] = competitions_data
-
-		# Display progress
-		num_completed += 1
-		print ("Number of users completed: " + str(num_completed))
-
-		# Save intermediate results
-		if num_completed % 250 == 0: np.save("user_id_to_competitions", result)
+	if not os.path.isfile(checkpoint_path): return result
+
+	with open(checkpoint_path, 'r') as f:
+		for line in f:
+			# A crash can leave a partially written last line
+			try:
+				record = json.loads(line)
+			except ValueError:
+				continue
+			result[record["userId"]] = record["competitions"]
+
+	return result
+
+
+# Opens the checkpoint log for appending, making sure a
+# partially written last line does not swallow the next record
+def open_checkpoint(checkpoint_path):
+	needs_newline = False
+	if os.path.isfile(checkpoint_path) and os.path.getsize(checkpoint_path) > 0:
+		with open(checkpoint_path, 'rb') as f:
+			f.seek(-1, os.SEEK_END)
+			needs_newline = f.read(1) != b"\n"
+
+	f = open(checkpoint_path, 'a')
+	if needs_newline: f.write("\n")
+	return f
+
+
+async def fetch_user_competitions(fetcher, user):
+	return user, await fetcher.fetch_json(competitions_path(user["userUrl"]))
+
+
+# Users already in the checkpoint log are skipped, so a
+# restarted crawl picks up where the last one stopped
+async def get_user_id_to_competitions_async(fetcher, user_data, checkpoint_path="user_id_to_competitions.jsonl"):
+	result = read_checkpoint(checkpoint_path)
+	remaining = [user for user in user_data if user["userId"] not in result]
+	num_completed = len(user_data) - len(remaining)
+	print ("Resuming with " + str(num_completed) + " users already completed")
+
+	with open_checkpoint(checkpoint_path) as checkpoint:
+		tasks = [fetch_user_competitions(fetcher, user) for user in remaining]
+		for task in asyncio.as_completed(tasks):
+			user, response = await task
+			
+			# Failed requests are not recorded so they are retried on restart
+			if response is None: continue
+			competitions_data = parse_competitions_data(response)
+			result[user["userId"]] = competitions_data
+
+			# Record the result as soon as it arrives
+			checkpoint.write(json.dumps({"userId": user["userId"], "competitions": competitions_data}) + "\n")
+			checkpoint.flush()
+
+			# Display progress
+			num_completed += 1
+			if num_completed % 250 == 0:
+				print ("Number of users completed: " + str(num_completed))
+				print ("Requests made: " + str(fetcher.num_requests) + ", throttled: " + str(fetcher.num_throttled))
+
+	return result
+
+
+def get_user_id_to_competitions(user_data, fetcher=None, checkpoint_path="user_id_to_competitions.jsonl"):
+	if fetcher is None: fetcher = AsyncFetcher()
+	try:
+		result = asyncio.run(get_user_id_to_competitions_async(fetcher, list(user_data), checkpoint_path))
+	finally:
+		fetcher.close()
 
 	# Save final results
 	np.save("user_id_to_competitions", result)
+	return result
 
 
 def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--base_url", help="server to scrape, e.g. a local mock server", default="https://www.kaggle.com")
+	parser.add_argument("--rate", help="initial requests per second", type=float, default=5.)
+	parser.add_argument("--concurrency", help="maximum number of requests in flight", type=int, default=8)
+	parser.add_argument("--competitions", help="also fetch the live competitions of every user", action="store_true")
+	parser.add_argument("--parse_html", help="print the users on saved rankings pages (files or directories) and exit", nargs='+')
+	args = parser.parse_args()
+
+	if args.parse_html:
+		for user in parse_saved_rankings(args.parse_html): print(user["displayName"])
+		return
+
 	# Load Kaggle user data, but only do network-bound work once
 	user_data = None
-	if not os.path.isfile("kaggle_users.npy"): user_data = scrape_kaggle_user_data()
-
-	''' 
-	Load user to competition dictionary; once again don't repeat network-bound work
-	Not used due to API rate limit issues:
+	if not os.path.isfile("kaggle_users.npy"): 
+		user_data = scrape_kaggle_user_data(AsyncFetcher(args.base_url, rate=args.rate, max_concurrency=args.concurrency))
+	else: user_data = np.load("kaggle_users.npy", allow_pickle=True)
 
-	user_id_to_competitions = None
-	if not os.path.isfile("user_id_to_competitions.npy"): user_id_to_competitions = get_user_id_to_competitions(user_data)
-	'''
+	# Load user to competition dictionary; once again don't repeat network-bound work
+	if args.competitions and not os.path.isfile("user_id_to_competitions.npy"):
+		get_user_id_to_competitions(user_data, AsyncFetcher(args.base_url, rate=args.rate, max_concurrency=args.concurrency))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,391 @@
+'''
+Array-backed engine for the Version 1 reallocation simulation.
+
+Users are integer IDs indexing a points array and every competition
+is an array of the IDs of its users. The random assignments for every
+iteration are drawn in one batched call, and since welfare only
+depends on the top num_retained competitors of a competition it is
+computed with np.partition instead of sorting whole leaderboards.
+The top num_retained of every competition before reallocation is
+computed once (see BaselineState), and iterations only record the
+users they add on top of it.
+'''
+
+import heapq
+import numpy as np
+from Profiling import phase
+
+
+# Boolean matrix where entry [c, u] is True if user u competes in competition c
+# competitor_ids holds one array of user IDs per competition
+def membership_matrix(competitor_ids, num_users):
+	result = np.zeros((len(competitor_ids), num_users), dtype=bool)
+	for comp_idx, ids in enumerate(competitor_ids): result[comp_idx, ids] = True
+	return result
+
+
+# Bounded top-k structure for one competition that keeps its welfare
+# (the sum of the k largest point totals) up to date as users are
+# inserted. Entries are (points, name) pairs kept in a min-heap, so
+# each insertion is O(log k) and nothing ever needs to be re-sorted.
+class TopKWelfare(object):
+	def __init__(self, k, entries=()):
+		self.k = k
+		self.heap = []
+		self.welfare = 0.0
+		for points, name in entries: self.insert(points, name)
+
+
+	# Returns the change in welfare caused by inserting the user
+	def insert(self, points, name):
+		if self.k <= 0: return 0.0
+
+		if len(self.heap) < self.k:
+			heapq.heappush(self.heap, (points, name))
+			self.welfare += points
+			return points
+
+		# Not good enough to displace the current k-th best
+		if points <= self.heap[0][0]: return 0.0
+
+		removed = heapq.heapreplace(self.heap, (points, name))
+		gain = points - removed[0]
+		self.welfare += gain
+		return gain
+
+
+# Sum of the k largest entries along the last axis
+# NOTE: non-members are expected to be filled with 0 points
+def top_k_sum(values, k):
+	n = values.shape[-1]
+	if k >= n: return values.sum(axis=-1)
+	if k <= 0: return np.zeros(values.shape[:-1])
+	return np.partition(values, n - k, axis=-1)[..., n - k:].sum(axis=-1)
+
+
+# The k largest entries along the last axis (unordered), padded
+# with zeros when there are fewer than k entries
+def top_k_values(values, k):
+	n = values.shape[-1]
+	if k <= 0: return np.zeros(values.shape[:-1] + (0,))
+	if k >= n:
+		pad = [(0, 0)] * (values.ndim - 1) + [(0, k - n)]
+		return np.pad(values, pad)
+	return np.partition(values, n - k, axis=-1)[..., n - k:]
+
+
+# Draws the competitions every eliminated user is assigned to for
+# every iteration at once. Returns a boolean array of shape
+# (num_iterations, num_users, num_competitions).
+#
+# Ordering competitions by U ** (1 / p) gives the same distribution as
+# np.random.choice(p=probabilities, replace=False), so the first
+# num_comps competitions in that order are a weighted sample
+# without replacement. Unless limit_entries is set every user enters
+# all competitions, which is what allocate_eliminated originally did
+# since it drew a full-size assignment.
+#
+# draws optionally holds the uniform numbers to use, with shape
+# (num_iterations, num_users, num_competitions + 1), see CommonRandomNumbers.
+def draw_assignments(num_users, probabilities, num_iterations, limit_entries=False, rng=None, draws=None):
+	num_comps = len(probabilities)
+	shape = (num_iterations, num_users, num_comps)
+	if not limit_entries: return np.ones(shape, dtype=bool)
+
+	if draws is None:
+		if rng is None: rng = np.random.default_rng()
+		draws = rng.random((num_iterations, num_users, num_comps + 1))
+
+	# User competes in a total of entries competitions, 1 <= entries <= num_comps / 2
+	return sample_entries(draws, np.asarray(probabilities, dtype=np.float64), max(num_comps // 2, 1))
+
+
+# Weighted sampling without replacement from uniform draws, shared by
+# draw_assignments and ScenarioEngine. The last entry of draws along the
+# last axis sets the number of competitions entered, between 1 and
+# max_entries, and the others order the competitions as in draw_assignments.
+# probabilities broadcasts against draws[..., :-1] and max_entries against
+# draws[..., -1]. Competitions with probability 0 are never entered.
+def sample_entries(draws, probabilities, max_entries):
+	entries = 1 + np.floor(draws[..., -1] * max_entries).astype(np.intp)
+
+	with np.errstate(divide="ignore"):
+		keys = np.log(draws[..., :-1]) / probabilities
+	ranks = np.argsort(np.argsort(-keys, axis=-1), axis=-1)
+	return ranks < entries[..., None]
+
+
+# The state of the normal competitions before reallocation, shared by every
+# iteration and never modified: the top num_retained points of every competition,
+# its welfare, and which eliminated users already compete in it.
+# competitor_ids holds one array of user IDs per competition.
+class BaselineState(object):
+	def __init__(self, points, competitor_ids, eliminated, num_retained):
+		self.num_retained = num_retained
+		self.eliminated = np.asarray(eliminated, dtype=np.intp)
+		self.eliminated_points = points[self.eliminated]
+		num_comps = len(competitor_ids)
+
+		with phase("sorting"):
+			self.top = np.array([top_k_values(points[ids], num_retained) for ids in competitor_ids])\
+						.reshape(num_comps, max(num_retained, 0))
+			self.before = self.top.sum(axis=1)
+
+		# present[c, j] is True if eliminated user j already competes in competition c
+		self.present = np.array([np.isin(self.eliminated, ids) for ids in competitor_ids], dtype=bool)\
+						.reshape(num_comps, len(self.eliminated))
+
+
+	# Number of competitions
+	def __len__(self):
+		return len(self.before)
+
+
+# Per-iteration welfare gains of every competition after the eliminated
+# users are reallocated. Returns (gains, assignments) where gains has
+# shape (num_iterations, num_competitions).
+#
+# Reallocation only ever inserts users, so the top num_retained after
+# reallocation always comes from the cached baseline top num_retained plus
+# the newly added users. Each iteration only records the points of the users
+# it adds, of which at most num_retained per competition are merged with
+# the baseline.
+def simulate_gains(baseline, probabilities, num_iterations, limit_entries=False, rng=None, draws=None):
+	k = baseline.num_retained
+
+	with phase("allocation"):
+		assignments = draw_assignments(len(baseline.eliminated), probabilities, num_iterations, limit_entries, rng, draws)
+
+	with phase("welfare"):
+		# Users already in a competition cannot be added to it again
+		added = assignments.transpose(0, 2, 1) & ~baseline.present
+		added_values = np.where(added, baseline.eliminated_points, 0.0)
+
+		# Only the k best added users can make it into the top k
+		num_added = added_values.shape[-1]
+		if 0 < k < num_added:
+			added_values.partition(num_added - k, axis=-1)
+			added_values = added_values[..., num_added - k:]
+
+		candidates = np.concatenate((np.broadcast_to(baseline.top, (num_iterations,) + baseline.top.shape),\
+									added_values), axis=-1)
+		after = top_k_sum(candidates, k)
+	return after - baseline.before, assignments
+
+
+# Probability that each competition is among those an eliminated user
+# enters, matching draw_assignments. The number of entries is uniform on
+# 1..num_comps / 2 and competitions are drawn in order without
+# replacement with the given probabilities. This is computed exactly by
+# dynamic programming over the sets of competitions drawn so far when there
+# are at most max_exact competitions, and estimated from num_samples draws otherwise.
+def inclusion_probabilities(probabilities, limit_entries=False, max_exact=16, num_samples=100000, rng=None):
+	probabilities = np.asarray(probabilities, dtype=np.float64)
+	num_comps = len(probabilities)
+	if not limit_entries: return np.ones(num_comps)
+
+	max_entries = max(num_comps // 2, 1)
+	if num_comps > max_exact:
+		result = np.zeros(num_comps)
+		chunk_size = max(1, 1000000 // num_comps)
+		for start in range(0, num_samples, chunk_size):
+			size = min(chunk_size, num_samples - start)
+			result += draw_assignments(size, probabilities, 1, True, rng)[0].sum(axis=0)
+		return result / num_samples
+
+	# Probability of every set of competitions (as a bitmask) being the first ones drawn
+	num_sets = 1 << num_comps
+	set_probs = np.zeros(num_sets)
+	set_probs[0] = 1.0
+	bits = (np.arange(num_sets)[:, None] >> np.arange(num_comps)) & 1
+	set_sizes = bits.sum(axis=1)
+	drawn_mass = bits @ probabilities
+
+	for size in range(max_entries):
+		for mask in np.flatnonzero((set_sizes == size) & (set_probs > 0)):
+			remaining = 1.0 - drawn_mass[mask]
+			if remaining <= 0: continue
+			for comp in np.flatnonzero(bits[mask] == 0):
+				set_probs[mask | (1 << comp)] += set_probs[mask] * probabilities[comp] / remaining
+
+	# Average P(competition is in the first m drawn) over m = 1..max_entries
+	result = np.zeros(num_comps)
+	for size in range(1, max_entries + 1):
+		result += bits[set_sizes == size].T @ set_probs[set_sizes == size]
+	return result / max_entries
+
+
+# Expected sum of the k largest values when value i is present independently
+# with probability present_probs[i]. Goes through the values from largest to
+# smallest keeping the distribution of how many present values came before,
+# since a value counts towards the sum only if fewer than k of those did.
+def expected_top_k_sum(values, present_probs, k):
+	if k <= 0: return 0.0
+	order = np.argsort(-values, kind="stable")
+
+	# before[j] = P(exactly j of the values seen so far are present), j < k
+	before = np.zeros(k)
+	before[0] = 1.0
+	total = 0.0
+
+	for value, prob in zip(values[order], present_probs[order]):
+		if value <= 0: break
+		if prob == 0: continue
+		total += value * prob * before.sum()
+
+		shifted = before * (1.0 - prob)
+		shifted[1:] += before[:-1] * prob
+		before = shifted
+
+	return total
+
+
+# Expected welfare gain of every competition over the random reallocation,
+# computed from inclusion probabilities instead of Monte Carlo draws.
+# inclusion[c] is the probability that an eliminated user enters competition c.
+def expected_gains(baseline, inclusion):
+	result = np.zeros(len(baseline))
+	for comp_idx in range(len(baseline)):
+		# Users already in a competition cannot be added to it again
+		new_entrant_points = baseline.eliminated_points[~baseline.present[comp_idx]]
+		values = np.concatenate((baseline.top[comp_idx], new_entrant_points))
+		present_probs = np.concatenate((np.ones(baseline.num_retained),\
+										np.full(len(new_entrant_points), inclusion[comp_idx])))
+		result[comp_idx] = expected_top_k_sum(values, present_probs, baseline.num_retained) - baseline.before[comp_idx]
+
+	return result
+
+
+# Streaming mean and variance of every competition's gain (Welford's
+# algorithm, with batches merged using Chan et al.'s parallel update)
+class RunningStats(object):
+	def __init__(self, num_comps):
+		self.count = 0
+		self.mean = np.zeros(num_comps)
+		self.m2 = np.zeros(num_comps)
+
+
+	# samples has shape (num_samples, num_comps)
+	def update(self, samples):
+		batch_count = len(samples)
+		if batch_count == 0: return
+		batch_mean = samples.mean(axis=0)
+		batch_m2 = ((samples - batch_mean) ** 2).sum(axis=0)
+
+		total = self.count + batch_count
+		delta = batch_mean - self.mean
+		self.mean = self.mean + delta * batch_count / total
+		self.m2 = self.m2 + batch_m2 + delta ** 2 * self.count * batch_count / total
+		self.count = total
+
+
+	def variance(self):
+		if self.count < 2: return np.full(len(self.mean), np.inf)
+		return self.m2 / (self.count - 1)
+
+
+	# Half-width of the normal-approximation confidence interval of the mean
+	def half_width(self, confidence=0.95):
+		from statistics import NormalDist
+		z = NormalDist().inv_cdf(0.5 + confidence / 2.)
+		return z * np.sqrt(self.variance() / max(self.count, 1))
+
+
+# Runs simulate_gains in batches of batch_size iterations until the confidence
+# interval of every competition's mean gain is narrower than +/- tolerance points,
+# or until max_iterations. Without a tolerance exactly max_iterations are run.
+# If common is a CommonRandomNumbers its draws are used instead of rng.
+# on_batch, if given, is called with the assignments of every batch.
+# Batches are split so that no iteration array holds more than
+# max_chunk_elements entries, which does not change the draws.
+# Returns (stats, assignments) where assignments are those of the last batch.
+def simulate_until_converged(baseline, probabilities, tolerance=None, confidence=0.95, batch_size=25,\
+							min_iterations=50, max_iterations=100, limit_entries=False, rng=None, common=None,\
+							max_chunk_elements=1 << 24, on_batch=None):
+	stats = RunningStats(len(baseline))
+	if tolerance is None: batch_size = max_iterations
+	per_iteration = max(len(baseline) * (len(baseline.eliminated) + baseline.num_retained), 1)
+	batch_size = max(1, min(batch_size, max_chunk_elements // per_iteration))
+
+	assignments = None
+	while stats.count < max_iterations:
+		size = min(batch_size, max_iterations - stats.count)
+		draws = None
+		if common is not None and limit_entries: draws = common.draws(baseline.eliminated, stats.count, stats.count + size)
+		gains, assignments = simulate_gains(baseline, probabilities, size, limit_entries, rng, draws)
+		stats.update(gains)
+		if on_batch is not None: on_batch(assignments)
+
+		if tolerance is not None and stats.count >= min_iterations\
+			and np.all(stats.half_width(confidence) <= tolerance): break
+
+	return stats, assignments
+
+
+# Pre-determined uniform numbers for a fixed set of users, used to compare
+# configurations under common random numbers. Iteration i always uses the
+# stream spawned from the seed with key i, and within it every user has a
+# fixed row, so a user eliminated under two different configurations makes
+# exactly the same choices in both. Differences between the configurations
+# then only reflect the configurations themselves and not sampling noise.
+class CommonRandomNumbers(object):
+	def __init__(self, user_ids, num_comps, seed=None):
+		self.seed_seq = np.random.SeedSequence(seed)
+		self.num_comps = num_comps
+		self.num_users = len(user_ids)
+
+		# Row of every user ID in the draws of an iteration
+		self.rows = np.full(int(np.max(user_ids, initial=-1)) + 1, -1, dtype=np.intp)
+		self.rows[user_ids] = np.arange(len(user_ids))
+
+
+	def iteration_draws(self, iteration):
+		seed_seq = np.random.SeedSequence(self.seed_seq.entropy, spawn_key=(iteration,))
+		return np.random.default_rng(seed_seq).random((self.num_users, self.num_comps + 1))
+
+
+	# Draws for the given users over iterations start..stop - 1, in the form
+	# expected by draw_assignments
+	def draws(self, user_ids, start, stop):
+		rows = self.rows[user_ids]
+		return np.stack([self.iteration_draws(iteration)[rows] for iteration in range(start, stop)])\
+				if stop > start else np.zeros((0, len(rows), self.num_comps + 1))
+
+
+# Everything perform_simulation computes for one configuration, so that
+# plotting and reporting never have to recompute it. Arrays are indexed
+# like competitions, and tier frequencies are (grandmasters, masters, experts).
+class SimulationResult(object):
+	def __init__(self, gold_competition, competitions, num_retained, before_welfare, gains,\
+				half_widths=None, num_iterations=None, gold_frequencies=None,\
+				frequencies_before=None, frequencies_after=None, iteration_frequencies=None):
+		self.gold_competition = gold_competition
+		self.competitions = list(competitions)
+		self.num_retained = num_retained
+		self.before_welfare = np.asarray(before_welfare, dtype=np.float64)
+		self.gains = np.asarray(gains, dtype=np.float64)
+		# Confidence half-widths of the gains, None for analytic results
+		self.half_widths = half_widths
+		self.num_iterations = num_iterations
+		self.gold_frequencies = gold_frequencies
+		# Tier frequencies before reallocation and after the last allocation drawn
+		self.frequencies_before = frequencies_before
+		self.frequencies_after = frequencies_after
+		# Tier frequencies after every allocation drawn, of shape (iterations, competitions, 3)
+		self.iteration_frequencies = iteration_frequencies
+
+
+	@property
+	def after_welfare(self):
+		return self.before_welfare + self.gains
+
+
+	# Mapping from competition name to average gain
+	@property
+	def average_gains(self):
+		return {name: float(gain) for name, gain in zip(self.competitions, self.gains)}
+
+
+	# Average gain over all competitions, as used to pick num_retained
+	def mean_gain(self):
+		return float(self.gains.mean()) if len(self.gains) else 0.0
@@ -0,0 +1,243 @@
+'''
+Synthetic datasets for stress testing the simulation at scale.
+
+Generates a user store and a directory of leaderboards that look like
+the shipped data: tiers are drawn with the shipped tier shares, points
+are resampled from the shipped points of the same tier, and every
+leaderboard copies the size, share of ranked users and tier mix of a
+randomly chosen shipped leaderboard. Repeat participation is kept too:
+every active user enters as many leaderboards as a resampled shipped
+user of the same tier, and only as many users are active as fill the
+leaderboards, so the overlap between leaderboards matches the shipped
+data (see EntrantPool). Users and leaderboards are written
+to disk in chunks, so a million users and a thousand competitions never
+have to fit in memory at once:
+	python SyntheticData.py synthetic --users 1000000 --competitions 1000
+
+The output directory holds the user store (users/), the leaderboards
+(leaderboards/) and the payout of every competition (payouts.json), and
+can be opened with load_synthetic_dataset.
+'''
+
+import argparse
+import json
+import os
+import shutil
+import numpy as np
+from numpy.lib.format import open_memmap
+import V1Simulation
+from LeaderboardStore import LeaderboardStore
+from UserStore import COLUMNS, TIERS, UserStore, load_user_store
+
+# Name of the synthetic gold competition, which copies the shipped one
+gold_template = "two-sigma-financial-news"
+
+
+# Distributions of the shipped data the generator draws from
+def fit_distributions(users, store, payouts):
+	name_to_id = users.index()[2]
+	tier_counts = np.bincount(users.tiers, minlength=len(TIERS))
+
+	# Every non-empty leaderboard is a template for the synthetic ones, described by
+	# its size, the share of its entrants that are ranked users and their tier mix
+	templates = {}
+	boards_per_user = np.zeros(len(users), dtype=np.int64)
+	for competition in store.competition_names():
+		competitor_ids = store.competitor_ids(competition, name_to_id)
+		boards_per_user[np.unique(competitor_ids)] += 1
+		size = len(store.usernames(competition))
+		if size == 0: continue
+		ranked_tiers = np.bincount(users.tiers[competitor_ids], minlength=len(TIERS))
+		templates[competition] = (size, ranked_tiers.sum() / float(size), ranked_tiers / max(ranked_tiers.sum(), 1))
+
+	# Number of leaderboards entered by every user on at least one, by tier
+	active = boards_per_user > 0
+	tier_activity = [boards_per_user[active & (users.tiers == code)] for code in range(len(TIERS))]
+
+	return {
+		"tier_shares": tier_counts / float(tier_counts.sum()),
+		"tier_points": [np.sort(np.asarray(users.points[users.tiers == code], dtype=np.float64)) for code in range(len(TIERS))],
+		"templates": templates,
+		"tier_activity": tier_activity,
+		"payouts": [payout for competition, payout in sorted(payouts.items()) if competition != gold_template],
+		"gold_payout": payouts[gold_template],
+	}
+
+
+# Writes num_users users in chunks straight into memory-mapped store columns
+# Names are "user" followed by the zero-padded user ID, so they are unique
+# and all have the same length
+def write_users(fit, num_users, store_dir, rng, chunk_size):
+	if not os.path.isdir(store_dir): os.mkdir(store_dir)
+	width = len("user") + len(str(max(num_users - 1, 0)))
+
+	shapes = {"names": (num_users * width,), "name_offsets": (num_users + 1,), "tiers": (num_users,),\
+				"points": (num_users,), "user_ids": (num_users,)}
+	dtypes = {"names": np.uint8, "name_offsets": np.int64, "tiers": np.uint8, "points": np.float32, "user_ids": np.int64}
+	columns = {column: open_memmap(os.path.join(store_dir, column + ".npy"), mode='w+', dtype=dtypes[column],\
+								shape=shapes[column]) for column in COLUMNS}
+
+	columns["name_offsets"][:] = np.arange(num_users + 1, dtype=np.int64) * width
+	for start in range(0, num_users, chunk_size):
+		stop = min(start + chunk_size, num_users)
+		names = "".join("user" + str(user_id).zfill(width - len("user")) for user_id in range(start, stop))
+		columns["names"][start * width:stop * width] = np.frombuffer(names.encode("ascii"), dtype=np.uint8)
+
+		# Points are resampled from the shipped users of the same tier
+		tiers = rng.choice(len(TIERS), size=stop - start, p=fit["tier_shares"])
+		points = np.zeros(stop - start)
+		for code in np.unique(tiers):
+			in_tier = tiers == code
+			points[in_tier] = rng.choice(fit["tier_points"][code], size=in_tier.sum())
+
+		columns["tiers"][start:stop] = tiers
+		columns["points"][start:stop] = points
+		columns["user_ids"][start:stop] = np.arange(start, stop)
+
+	for column in COLUMNS: columns[column].flush()
+	del columns
+
+
+# Leaderboard entries of the active users of one tier. Every active user
+# holds as many entries as the number of leaderboards it enters, and
+# leaderboards take entries in a random order, so users enter exactly that
+# many leaderboards (an entry is dropped if its user is already on the
+# leaderboard). If the entries run out they are reshuffled and reused.
+class EntrantPool(object):
+	def __init__(self, active_ids, num_boards, rng):
+		self.entries = np.repeat(np.asarray(active_ids, dtype=np.intp), num_boards)
+		self.rng = rng
+		self.position = len(self.entries)
+
+
+	# The distinct users of the next count entries
+	def draw(self, count):
+		chosen = [self.entries[:0]]
+		if len(self.entries) == 0: return chosen[0]
+		while count > 0:
+			if self.position == len(self.entries):
+				self.rng.shuffle(self.entries)
+				self.position = 0
+			taken = self.entries[self.position:self.position + count]
+			self.position += len(taken)
+			count -= len(taken)
+			chosen.append(taken)
+		return np.unique(np.concatenate(chosen))
+
+
+# EntrantPool of every tier. Every active user enters as many leaderboards
+# as a shipped user of the same tier, and every tier gets as many active
+# users as fill its expected number of leaderboard entries, so repeat
+# participation and the overlap between leaderboards match the shipped data.
+def entrant_pools(fit, users, templates, rng, entrant_scale):
+	expected_entries = np.zeros(len(TIERS))
+	for size, ranked_share, tier_mix in templates:
+		expected_entries += max(int(round(size * entrant_scale)), 1) * ranked_share * np.asarray(tier_mix)
+
+	pools = []
+	for code in range(len(TIERS)):
+		ranked_ids, activity = np.flatnonzero(users.tiers == code), fit["tier_activity"][code]
+		num_active = 0
+		if len(ranked_ids) and len(activity):
+			num_active = min(len(ranked_ids), max(int(round(expected_entries[code] / activity.mean())), 1))
+		active_ids = rng.choice(ranked_ids, size=num_active, replace=False)
+		pools.append(EntrantPool(active_ids, rng.choice(activity, size=num_active) if num_active else [], rng))
+	return pools
+
+
+# Writes one leaderboard modelled on a shipped template. pools holds the
+# EntrantPool of every tier, next_guest numbers the entrants that are not
+# ranked users. Returns the next unused guest number.
+def write_leaderboard(path, template, users, pools, rng, entrant_scale, next_guest):
+	size, ranked_share, tier_mix = template
+	size = max(int(round(size * entrant_scale)), 1)
+	tier_counts = rng.multinomial(rng.binomial(size, ranked_share), tier_mix)
+
+	entrants = []
+	for code, count in enumerate(tier_counts):
+		entrants += [users.name(user_id) for user_id in pools[code].draw(count)]
+
+	num_guests = size - len(entrants)
+	entrants += ["guest" + str(guest) for guest in range(next_guest, next_guest + num_guests)]
+	rng.shuffle(entrants)
+
+	# Only the username column is ever read
+	with open(path, 'w', encoding="utf-8") as f:
+		f.write("TeamId,TeamName,SubmissionDate,Score\n")
+		for rank, username in enumerate(entrants): f.write(str(rank) + "," + username + ",,\n")
+
+	return next_guest + num_guests
+
+
+# Generates a synthetic dataset in out_dir, see the module docstring
+# Leftovers of an earlier dataset would be mixed into the new one, so a
+# non-empty out_dir is only written to (after removing it) if force is true
+def generate_dataset(fit, out_dir, num_users, num_competitions, seed=None, chunk_size=100000, entrant_scale=1.,\
+					force=False):
+	if os.path.isdir(out_dir) and os.listdir(out_dir):
+		if not force: raise FileExistsError(out_dir + " is not empty, pass force=True (--force) to replace it")
+		shutil.rmtree(out_dir)
+
+	rng = np.random.default_rng(seed)
+	if not os.path.isdir(out_dir): os.mkdir(out_dir)
+
+	write_users(fit, num_users, os.path.join(out_dir, "users"), rng, chunk_size)
+	users = UserStore(os.path.join(out_dir, "users"))
+
+	leaderboards_dir = os.path.join(out_dir, "leaderboards")
+	if not os.path.isdir(leaderboards_dir): os.mkdir(leaderboards_dir)
+
+	# Competition 0 is the gold competition and copies the shipped one
+	normal_templates = [fit["templates"][name] for name in sorted(fit["templates"]) if name != gold_template]
+	width = len(str(max(num_competitions - 1, 0)))
+	competitions = ["synthetic-" + str(comp_idx).zfill(width) for comp_idx in range(num_competitions)]
+	templates = [fit["templates"][gold_template]]\
+				+ [normal_templates[idx] for idx in rng.integers(len(normal_templates), size=num_competitions - 1)]
+	payouts = {competitions[0]: fit["gold_payout"]}
+	for competition in competitions[1:]: payouts[competition] = float(rng.choice(fit["payouts"]))
+
+	# The active users are chosen once all leaderboard sizes are known
+	pools = entrant_pools(fit, users, templates, rng, entrant_scale)
+	next_guest = 0
+	for competition, template in zip(competitions, templates):
+		next_guest = write_leaderboard(os.path.join(leaderboards_dir, competition + "-publicleaderboard.csv"),\
+										template, users, pools, rng, entrant_scale, next_guest)
+
+	with open(os.path.join(out_dir, "payouts.json"), 'w') as f:
+		json.dump({"gold_competition": "synthetic-" + "0" * width, "payouts": payouts}, f, indent=1)
+
+
+# Returns (users, store, payouts, gold_competition) for a dataset written by generate_dataset
+def load_synthetic_dataset(out_dir):
+	with open(os.path.join(out_dir, "payouts.json"), 'r') as f: manifest = json.load(f)
+
+	users = UserStore(os.path.join(out_dir, "users"))
+	store = LeaderboardStore(os.path.join(out_dir, "leaderboards"), os.path.join(out_dir, "leaderboards_cache.npz"))
+	return users, store, manifest["payouts"], manifest["gold_competition"]
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("out_dir", help="directory to write the dataset to")
+	parser.add_argument("--users", help="number of ranked users", type=int, default=1000000)
+	parser.add_argument("--competitions", help="number of competitions, the first of which is the gold competition", type=int, default=1000)
+	parser.add_argument("--entrant_scale", help="factor to scale the size of every leaderboard by", type=float, default=1.)
+	parser.add_argument("--chunk_size", help="number of users generated at a time", type=int, default=100000)
+	parser.add_argument("--seed", help="seed for the generator", type=int, default=None)
+	parser.add_argument("--force", help="remove out_dir first if it is not empty", action="store_true")
+	args = parser.parse_args()
+
+	if not args.force and os.path.isdir(args.out_dir) and os.listdir(args.out_dir):
+		parser.error(args.out_dir + " is not empty, pass --force to replace it")
+
+	# The shipped data the synthetic data is modelled on
+	fit = fit_distributions(load_user_store("kaggle_users_store", "kaggle_users.npy"),\
+							V1Simulation.get_leaderboard_store(), V1Simulation.competitions_to_payouts)
+
+	generate_dataset(fit, args.out_dir, args.users, args.competitions, args.seed, args.chunk_size, args.entrant_scale,\
+					args.force)
+	print ("Wrote " + str(args.users) + " users and " + str(args.competitions) + " competitions to " + args.out_dir)
+
+
+if __name__ == "__main__":
+	main()
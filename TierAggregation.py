@@ -0,0 +1,69 @@
+'''
+Vectorized tier-frequency and payout-bucket tables.
+
+Tiers are the integer codes of UserStore and competitions are arrays
+of user IDs, so counting the users of every tier in every competition
+is a single np.bincount. Reallocations are boolean arrays of shape
+(iterations, competitions, eliminated users), and the tier counts after
+every iteration are computed at once with one matrix product. Payout
+buckets are found with np.digitize over configurable edges, and the
+per-bucket tables are again computed for every iteration at once.
+
+Frequency tables list (grandmasters, masters, experts), the order the
+plots use.
+'''
+
+import numpy as np
+from UserStore import TIERS, TIER_CODES
+
+# Tier codes of the columns of every frequency table
+REPORTED_TIERS = np.array([TIER_CODES["grandmaster"], TIER_CODES["master"], TIER_CODES["expert"]], dtype=np.intp)
+
+# Upper edges (inclusive) of the payout buckets: 0 to 25K, 25K to 50K, 50K to 75K and above 75K
+PAYOUT_EDGES = (25000., 50000., 75000.)
+
+
+# Tier frequencies of every competition, of shape (competitions, reported tiers)
+# competitor_ids holds one array of user IDs per competition
+def competition_tier_counts(competitor_ids, tiers):
+	num_comps = len(competitor_ids)
+	sizes = np.array([len(ids) for ids in competitor_ids], dtype=np.intp)
+	ids = np.concatenate([np.asarray(ids, dtype=np.intp) for ids in competitor_ids] + [np.zeros(0, dtype=np.intp)])
+
+	# Competition c and tier t are counted in bin c * len(TIERS) + t
+	bins = np.repeat(np.arange(num_comps), sizes) * len(TIERS) + tiers[ids]
+	counts = np.bincount(bins, minlength=num_comps * len(TIERS)).reshape(num_comps, len(TIERS))
+	return counts[:, REPORTED_TIERS]
+
+
+# Tier frequencies of every competition after every iteration, of shape
+# (iterations, competitions, reported tiers). added[i, c, j] is True if
+# eliminated user j was added to competition c in iteration i, and
+# before holds the frequencies before reallocation.
+def iteration_tier_counts(before, added, eliminated_tiers):
+	one_hot = (np.asarray(eliminated_tiers)[:, None] == REPORTED_TIERS[None, :]).astype(np.int64)
+	return before[None] + np.matmul(added.astype(np.int64), one_hot)
+
+
+# Bucket of every payout, 0 for payouts up to edges[0] and so on
+def payout_buckets(payouts, edges=PAYOUT_EDGES):
+	return np.digitize(payouts, edges, right=True)
+
+
+# Average frequencies of the competitions in every payout bucket. counts has
+# shape (..., competitions, reported tiers) and the result has shape
+# (..., buckets, reported tiers), NaN for buckets without competitions.
+def bucket_means(counts, payouts, edges=PAYOUT_EDGES):
+	buckets = payout_buckets(payouts, edges)
+	one_hot = (buckets[:, None] == np.arange(len(edges) + 1)[None, :]).astype(np.float64)
+	sums = np.einsum("...ct,cb->...bt", np.asarray(counts, dtype=np.float64), one_hot)
+
+	with np.errstate(divide="ignore", invalid="ignore"):
+		return sums / one_hot.sum(axis=0)[:, None]
+
+
+# Axis labels of the payout buckets, e.g. "25K to 50K"; the last bucket ends at the largest payout
+def payout_bucket_labels(payouts, edges=PAYOUT_EDGES):
+	bounds = [0.] + list(edges) + [max(max(payouts), edges[-1])]
+	names = [str(int(bound // 1000)) + "K" if bound else "0" for bound in bounds]
+	return tuple(low + " to " + high for low, high in zip(names[:-1], names[1:]))
@@ -0,0 +1,136 @@
+'''
+Columnar storage for the Kaggle user table.
+
+The store is a directory of plain .npy files: a UTF-8 string table
+for display names (one byte blob plus offsets), uint8 tier codes,
+float32 points and int64 user IDs. Every column is memory-mapped on
+load, so opening the store is zero-copy and never needs allow_pickle.
+
+To convert the scraped kaggle_users.npy (an object array of dicts)
+into a store, run:
+	python UserStore.py kaggle_users.npy kaggle_users_store
+'''
+
+import argparse
+import os
+import numpy as np
+
+# Tier code is the index into this tuple
+TIERS = ("novice", "contributor", "expert", "master", "grandmaster")
+TIER_CODES = {tier: code for code, tier in enumerate(TIERS)}
+
+COLUMNS = ("names", "name_offsets", "tiers", "points", "user_ids")
+
+
+class UserStore(object):
+	def __init__(self, store_dir="kaggle_users_store"):
+		self.store_dir = store_dir
+		self.columns = {}
+		for column in COLUMNS:
+			self.columns[column] = np.load(os.path.join(store_dir, column + ".npy"), mmap_mode='r', allow_pickle=False)
+
+		self.tiers = self.columns["tiers"]
+		self.points = self.columns["points"]
+		self.user_ids = self.columns["user_ids"]
+
+		# Built on first use, see index
+		self._index = None
+		self._user_info = None
+
+
+	# Worker processes reopen the memory-mapped columns
+	# instead of receiving a pickled copy of them
+	def __getstate__(self):
+		return {"store_dir": self.store_dir}
+
+
+	def __setstate__(self, state):
+		self.__init__(state["store_dir"])
+
+
+	def __len__(self):
+		return len(self.points)
+
+
+	def name(self, user_id):
+		offsets = self.columns["name_offsets"]
+		return bytes(self.columns["names"][offsets[user_id]:offsets[user_id + 1]]).decode("utf-8")
+
+
+	def names(self):
+		blob = bytes(self.columns["names"]).decode("utf-8")
+		# Offsets are in bytes, so decode each name separately when
+		# the blob is not pure ASCII
+		if len(blob) == len(self.columns["names"]):
+			offsets = self.columns["name_offsets"]
+			return [blob[offsets[idx]:offsets[idx + 1]] for idx in range(len(self))]
+		return [self.name(idx) for idx in range(len(self))]
+
+
+	def tier(self, user_id):
+		return TIERS[self.tiers[user_id]]
+
+
+	# Returns (names, points, name_to_id), where points is a float64
+	# array and name_to_id maps every username to its user ID
+	def index(self):
+		if self._index is None:
+			names = self.names()
+			name_to_id = {name: idx for idx, name in enumerate(names)}
+			self._index = (names, np.asarray(self.points, dtype=np.float64), name_to_id)
+		return self._index
+
+
+	# Returns a mapping from username to (tier, points) as built by get_user_info
+	def user_info(self):
+		if self._user_info is None:
+			names = self.index()[0]
+			tiers = [TIERS[code] for code in self.tiers]
+			self._user_info = dict(zip(names, zip(tiers, self.points.tolist())))
+		return self._user_info
+
+
+# Writes the columns of a store for a sequence of user dicts as scraped by ScrapeKaggle
+# NOTE: like get_user_info, a display name that appears more than once keeps the
+# values of its last occurrence
+def write_user_store(user_data, store_dir):
+	users = {}
+	for user in user_data: users[user["displayName"]] = user
+	users = list(users.values())
+
+	encoded = [user["displayName"].encode("utf-8") for user in users]
+	columns = {
+		"names": np.frombuffer(b"".join(encoded), dtype=np.uint8),
+		"name_offsets": np.cumsum([0] + [len(name) for name in encoded], dtype=np.int64),
+		"tiers": np.array([TIER_CODES[user["tier"]] for user in users], dtype=np.uint8),
+		"points": np.array([user["points"] for user in users], dtype=np.float32),
+		"user_ids": np.array([user["userId"] for user in users], dtype=np.int64),
+	}
+
+	if not os.path.isdir(store_dir): os.mkdir(store_dir)
+	for column in COLUMNS: np.save(os.path.join(store_dir, column + ".npy"), columns[column])
+
+
+# One-time conversion of the pickled object array saved by ScrapeKaggle
+def convert_user_data(npy_path="kaggle_users.npy", store_dir="kaggle_users_store"):
+	write_user_store(np.load(npy_path, allow_pickle=True), store_dir)
+
+
+# Opens the store, converting npy_path first if the store does not exist yet
+def load_user_store(store_dir="kaggle_users_store", npy_path="kaggle_users.npy"):
+	if not os.path.isdir(store_dir): convert_user_data(npy_path, store_dir)
+	return UserStore(store_dir)
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("npy_path", help="object array of user dicts saved by ScrapeKaggle", nargs='?', default="kaggle_users.npy")
+	parser.add_argument("store_dir", help="directory to write the columnar store to", nargs='?', default="kaggle_users_store")
+	args = parser.parse_args()
+
+	convert_user_data(args.npy_path, args.store_dir)
+	print ("Wrote " + str(len(UserStore(args.store_dir))) + " users to " + args.store_dir)
+
+
+if __name__ == "__main__":
+	main()
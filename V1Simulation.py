@@ -12,16 +12,23 @@ Last Edited: 12/7/2018
 
 import json
 import numpy as np
-import pandas as pd
 import os
 import operator
-import copy
-from matplotlib import pyplot as plt
-from matplotlib import rc
 import argparse
-import zipfile
-
-# Number of users kept in the gold competition
+from functools import partial
+from SimulationEngine import TopKWelfare, draw_assignments, expected_gains, inclusion_probabilities,\
+	membership_matrix, simulate_until_converged, BaselineState, CommonRandomNumbers, SimulationResult
+from LeaderboardStore import LeaderboardStore
+from ScenarioEngine import Scenario, evaluate_scenarios
+from DynamicSimulation import DynamicSimulation
+from PlotRendering import PlotQueue
+from Profiling import PhaseProfiler, current_profiler, phase
+from ResultCache import ResultCache, dataset_fingerprint
+from TierAggregation import PAYOUT_EDGES, bucket_means, competition_tier_counts, iteration_tier_counts,\
+	payout_bucket_labels
+from UserStore import load_user_store
+
+# Default number of users kept in the gold competition
 num_retained = 100
 
 # Mapping from competition name to payout
@@ -34,8 +41,18 @@ competitions_to_payouts =\
 "traveling-santa-2018-prime-paths": 25000., "PLAsTiCC-2018":25000.}
 
 
+# Leaderboards are only parsed once per process, see get_leaderboard_store
+leaderboard_store = None
+
+# Fingerprint of the data used by the result cache, see get_data_fingerprint
+data_fingerprint = None
+
+
 # Unzip files and create new directory
+# NOTE: the simulation reads the archives directly, this is only
+# needed to look at the CSVs by hand
 def form_leaderboards_dir():
+	import zipfile
 	for fname in os.listdir("Leaderboards_zip"):
 		if (fname == ".DS_Store"): continue
 		f_title = fname.split('.')[0] + ".csv"
@@ -43,21 +60,30 @@ def form_leaderboards_dir():
 			zip_ref.extractall("Leaderboards")
 
 
+# Returns the leaderboard store, loading it on first use
+def get_leaderboard_store():
+	global leaderboard_store
+	if leaderboard_store is None: leaderboard_store = LeaderboardStore("Leaderboards_zip")
+	return leaderboard_store
+
+
 # Returns a sorted list over all competitors in the competition that are experts, masters, and grandmasters
 # NOTE: the list is sorted by tier and by points with in each tier
+# NOTE: user_info maps every user, so the simulation uses get_ranked_competitor_ids;
+# this is only used by the list-based reference path (see Benchmark.py)
 def get_competitors(competition, user_info):
-	usernames = set(user_info.keys())
-	competitors = set(pd.read_csv("./Leaderboards/" + competition + "-publicleaderboard.csv").values[:,1])
-	
-	# These are all of the users in our user dataset that also
-	# appear on the Kaggle leaderboards we are considering
-	overlap_users = competitors.intersection(usernames)
+	with phase("get_competitors"):
+		competitors = get_leaderboard_store().usernames(competition)
 
-	result = {}
-	for user in overlap_users: result[user] = user_info[user]
+		# These are all of the users in our user dataset that also
+		# appear on the Kaggle leaderboards we are considering
+		result = {}
+		for user in competitors:
+			if user in user_info: result[user] = user_info[user]
 
-	# Sort users by points from most to least
-	return sorted(result.items(), key=lambda x: x[1][1], reverse=True)
+		# Sort users by points from most to least
+		# Ties are broken by name so the order does not depend on set iteration order
+		return sorted(result.items(), key=lambda x: (-x[1][1], x[0]))
 
 
 	# This sorting procedure puts grandmasters above masters and masters
@@ -82,6 +108,16 @@ def get_competitors(competition, user_info):
 	'''
 
 
+# IDs of the ranked users of a competition in the order of get_competitors
+# (most to least points, ties broken by name), computed from the user
+# store's arrays instead of a mapping over every user
+def get_ranked_competitor_ids(competition, users):
+	with phase("get_competitors"):
+		names, points, name_to_id = users.index()
+		ids = np.unique(get_leaderboard_store().competitor_ids(competition, name_to_id))
+		return ids[np.lexsort((np.array([names[idx] for idx in ids]), -points[ids]))]
+
+
 # Returs a mapping from all experts, masters, and grandmasters
 # to a tuple (tier, points)
 def get_user_info(user_data):
@@ -90,49 +126,34 @@ def get_user_info(user_data):
 	return result
 
 
-# Sorts a dict mapping from competition name
-# to competitors as done in get_competitors
-def sort_competitors_dict(comp_to_competitors):
-	result = {}
-
-	for comp in comp_to_competitors.keys():
-		competitors = comp_to_competitors[comp]
-		result[comp] = sorted(competitors, key=lambda x: x[1][1], reverse=True)
-
-	return result
-
-
 # Allocate those eliminated from gold to new competitions
-def allocate_eliminated(user_info, normal_competition_names, probabilities, normal_competitors):
+# Rather than copying and re-sorting every competitor list, each competition is
+# backed by a TopKWelfare seeded with its current top num_retained, and users
+# are inserted into it. Returns a mapping from competition name to TopKWelfare.
+# NOTE: perform_simulation uses the vectorized simulate_gains instead; this
+# list-based path is kept as a reference and is timed by Benchmark.py
+def allocate_eliminated(eliminated_info, normal_competition_names, probabilities, normal_competitors,\
+						num_retained, limit_entries=False, rng=None):
 	# Assign all users to new competitions
-	choices = np.arange(0, len(normal_competition_names))
-	for user in user_info:
-		# User competes in a total of num_comps competitions
-		num_comps = np.random.randint(1, len(normal_competition_names) / 2 + 1)
-		
-		# Get num_comps competitions for user to compete in
-		assignment = list(np.random.choice(a=choices, p=probabilities, size=(len(normal_competition_names),), replace=False))
-
-		# Get the names of the competition to which user was assigned
-		# Necessary to access normal_competitors dictionary
-		assignment_comp_names = []
-		for comp_idx in assignment: assignment_comp_names.append(normal_competition_names[comp_idx])
-		
-		# Append user to all appropriate competitors lists
+	assignment = draw_assignments(len(eliminated_info), probabilities, 1, limit_entries, rng)[0]
+
+	result = {}
+	for comp_idx, comp_name in enumerate(normal_competition_names):
+		competitors = normal_competitors[comp_name]
+		top_k = TopKWelfare(num_retained, [(competitor[1][1], competitor[0]) for competitor in competitors[:num_retained]])
+
 		# Avoid adding users to a competition more than once
-		for comp_name in assignment_comp_names:
-			if user not in normal_competitors[comp_name]:
-				normal_competitors[comp_name].append(user)
+		present = set(competitor[0] for competitor in competitors)
+		for user_idx, user in enumerate(eliminated_info):
+			if assignment[user_idx, comp_idx] and user[0] not in present: top_k.insert(user[1][1], user[0])
 
-	# Need to apply the same sorting procedure as
-	# in get_competitors before returning
-	normal_competitors = sort_competitors_dict(normal_competitors)
-	return normal_competitors
+		result[comp_name] = top_k
+
+	return result
 
 
 # Computes the welfare for a given competition
-def compute_welfare(competitors, user_info):
-	 global num_retained
+def compute_welfare(competitors, user_info, num_retained):
 	 total = 0.0
 
 	 # Assuming only the top_competitors competitors matter
@@ -146,13 +167,14 @@ def compute_welfare(competitors, user_info):
 
 
 # Compute the reallocation gains
-def compute_gains(before, after, user_info):
+# before maps competitions to sorted competitor lists and
+# after maps them to the TopKWelfare returned by allocate_eliminated
+def compute_gains(before, after, user_info, num_retained):
 	result = {}
 
 	for competition in before.keys():
-		before_score = compute_welfare(before[competition], user_info)
-		after_score = compute_welfare(after[competition], user_info)
-		result[competition] = after_score - before_score
+		before_score = compute_welfare(before[competition], user_info, num_retained)
+		result[competition] = after[competition].welfare - before_score
 
 	return result
 
@@ -171,43 +193,24 @@ def make_readable(name):
 
 
 
-def make_category_histogram(frequencies, competition_name, after_comp, save_plots):
-	fig = plt.figure(figsize=(12.5, 7.5))
-	categories = ('Grandmasters', 'Masters', 'Experts')
-	y_pos = np.arange(len(categories))
-	plt.bar(y_pos, frequencies, align='center', alpha=0.5)
-	plt.xticks(y_pos, categories)
-	plt.ylabel('Number of competitors')
-	plt.xlabel('Competitor category')
-	if after_comp: plt.title('Number of competitors by category for ' + competition_name + " after reallocation")
-	else: plt.title('Number of competitors by category for ' + competition_name + "before reallocation")
-	if save_plots:
-		 
-		if after_comp: fig.savefig("plots/" + competition_name + "category_histogram" + "_after_reallocation.png", dpi=fig.dpi)
-		else: fig.savefig("plots/" + competition_name + "category_histogram.png", dpi=fig.dpi)
-	else: plt.show()
-
-
-
-def get_frequencies(competitor_info):
-	frequencies = [0, 0, 0]
-
-	for competitor in competitor_info:
-		if competitor[1][0] == "grandmaster": frequencies[0] += 1
-		elif competitor[1][0] == "master": frequencies[1] += 1
-		elif competitor[1][0] == "expert": frequencies[2] += 1
+def make_category_histogram(plots, frequencies, competition_name, after_comp):
+	if after_comp:
+		title = 'Number of competitors by category for ' + competition_name + " after reallocation"
+		filename = "plots/" + competition_name + "category_histogram" + "_after_reallocation.png"
+	else:
+		title = 'Number of competitors by category for ' + competition_name + "before reallocation"
+		filename = "plots/" + competition_name + "category_histogram.png"
+	plots.add("category_histogram", filename, frequencies=frequencies, title=title)
 
-	return frequencies
 
 
-def plot_competitor_info(normal_competitors_info, gold_competitors_info=None, after_comp=False, save_plots=False):
-	global num_retained
+def plot_competitor_info(plots, result, after_comp=False):
+	if not after_comp: 
+		make_category_histogram(plots, list(result.gold_frequencies), make_readable(result.gold_competition), after_comp)
 
-	if gold_competitors_info is not None: 
-		make_category_histogram(get_frequencies(gold_competitors_info), make_readable("two-sigma-financial-news"),after_comp, save_plots=save_plots)
-
-	for key in normal_competitors_info:
-		make_category_histogram(get_frequencies(normal_competitors_info[key]), make_readable(key), after_comp, save_plots=save_plots)
+	frequencies = result.frequencies_after if after_comp else result.frequencies_before
+	for comp_idx, key in enumerate(result.competitions):
+		make_category_histogram(plots, list(frequencies[comp_idx]), make_readable(key), after_comp)
 
 
 '''
@@ -221,94 +224,37 @@ changes as the payout is changed.
 Authors: John Solitario
 Last Edited: 12/7/2018
 '''
-def plot_payout_category_bars(gold_competitors_info, normal_competitors_info, after_comp, save_plots=False):
+def plot_payout_category_bars(plots, result, after_comp, payout_edges=PAYOUT_EDGES):
 	# Mapping from competition name to payout
 	global competitions_to_payouts
-	fig = plt.figure(figsize=(12.5, 7.5))
 
 # input:
-#	gold_competitors_info -- sorted list over all competitors in the gold competition:
-#	(sorting done by tier and by points with in each tier from grandmaster to expert
-#	and within each category from most to least points)
-#
-#	normal_competitors_info -- dict mapping from competition name to sorted list over
-#	all competitors in the gold competition (sorted done as in gold_competitors_info)
+#	result -- SimulationResult holding the tier frequencies of the gold competition
+#	and of every normal competition before and after reallocation
 
 
 	# Index 0 -> granndmaster, Index 1 -> master, Index 2 -> expert
-	frequencies = {}
-	for comp in normal_competitors_info:
-		frequencies[comp] = get_frequencies(normal_competitors_info[comp])
-	frequencies["two-sigma-financial-news"] = get_frequencies(gold_competitors_info)
-
-	bar1, bar2, bar3, bar4 = [0, 0, 0], [0, 0, 0], [0, 0, 0], [0, 0, 0] # bucket1 0 - 25,000, bucket2 25,001 - 50,000, etc.
-	bucket1_count, bucket2_count, bucket3_count, bucket4_count = 0, 0, 0, 0
-
-	for comp in frequencies:
-		if competitions_to_payouts[comp] <= 25000:
-			bucket1_count += 1
-			frequency = frequencies[comp]
-			for index in range(3): bar1[index] += frequency[index]
-		elif competitions_to_payouts[comp] > 25000 and competitions_to_payouts[comp] <= 50000: 
-			bucket2_count += 1
-			frequency = frequencies[comp]
-			for index in range(3): bar2[index] += frequency[index]
-		elif competitions_to_payouts[comp] > 50000 and competitions_to_payouts[comp] <= 75000: 
-			bucket3_count += 1
-			frequency = frequencies[comp]
-			for index in range(3): bar3[index] += frequency[index]
-		else: 
-			bucket4_count += 1
-			frequency = frequencies[comp]
-			for index in range(3): bar4[index] += frequency[index]
-
-	for index in range(3):
-		bar1[index] = float(bar1[index]) / bucket1_count
-		bar2[index] = float(bar2[index]) / bucket2_count
-		bar3[index] = float(bar3[index]) / bucket3_count
-		bar4[index] = float(bar4[index]) / bucket4_count
-
-		grandmasters = [bar1[0], bar2[0], bar3[0], bar4[0]]
-		masters = [bar1[1], bar2[1], bar3[1], bar4[1]]
-		experts = [bar1[2], bar2[2], bar3[2], bar4[2]]
-		ind = np.arange(4)
-		bars = [bar1[1] + bar1[2], bar2[1] + bar2[2], bar3[1] + bar3[2], bar4[1] + bar4[2]]
-
-
-	p1 = plt.bar(ind, experts) 
-	p2 = plt.bar(ind, masters, bottom = experts) 
-	p3 = plt.bar(ind, grandmasters, bottom = bars)
-
-	plt.ylabel('Average Number of Participants')
-	if after_comp: plt.title('After Reallocation: Partipation Compared to Competition Payout')
-	else: plt.title('Before Reallocation: Partipation Compared to Competition Payout')
-
-	plt.xticks(ind, ('0 to 25K', '25K to 50K', '50K to 75K', '75K to 100K'))
-	plt.xlabel('Total Competition Payout ($)')
-	plt.legend((p1[0], p2[0], p3[0]), ('Experts', 'Masters', 'Grandmasters'))
-	if save_plots:
-		if after_comp: fig.savefig("plots/payout_category" + "_after_reallocation", dpi=fig.dpi)
-		else: fig.savefig("plots/payout_category", dpi=fig.dpi)
-	else: plt.show()
-
-
-# This just plots the orange part of what we plotted below
-def plot_point_gains_simple(r, bars, barWidth, shortened_names, save_plots):
-	fig = plt.figure(figsize=(12.5, 7.5))
+	normal_frequencies = result.frequencies_after if after_comp else result.frequencies_before
+	frequencies = np.vstack((normal_frequencies, result.gold_frequencies))
+	payouts = [competitions_to_payouts[comp] for comp in result.competitions + [result.gold_competition]]
 
-	plt.bar(r, bars, edgecolor='white', width=barWidth)
-	 
-	# Custom X axis
-	plt.xticks(r, shortened_names, fontweight='bold')
-	plt.xlabel("Competition")
+	# Average frequencies of the competitions in every payout bucket
+	bars = bucket_means(frequencies, payouts, payout_edges)
+	grandmasters, masters, experts = [list(bars[:, index]) for index in range(3)]
 
-	#Custom Y axis
-	plt.ylabel("Point gains")
+	if after_comp:
+		title = 'After Reallocation: Partipation Compared to Competition Payout'
+		filename = "plots/payout_category" + "_after_reallocation"
+	else:
+		title = 'Before Reallocation: Partipation Compared to Competition Payout'
+		filename = "plots/payout_category"
+	plots.add("payout_category_bars", filename, grandmasters=grandmasters, masters=masters, experts=experts, title=title,\
+				labels=payout_bucket_labels(payouts, payout_edges))
 
-	plt.title("Points gained due to reallocation")
 
-	if save_plots: fig.savefig("plots/point_gains_simple", dpi=fig.dpi)
-	else: plt.show()
+# This just plots the orange part of what we plotted below
+def plot_point_gains_simple(plots, r, bars, barWidth, shortened_names):
+	plots.add("point_gains_simple", "plots/point_gains_simple", r=r, bars=bars, bar_width=barWidth, names=shortened_names)
 
 
 
@@ -319,7 +265,7 @@ Using a stacked bar chart
 Author: Sam Sklar
 Last Edited 12/7/2018
 '''
-def plot_point_gains(average_gains, user_info, save_plots=False):
+def plot_point_gains(plots, result):
     bars1 = []
     bars2 = []
     r = []
@@ -327,22 +273,22 @@ def plot_point_gains(average_gains, user_info, save_plots=False):
     shortened_names = ["Airbus", "Doodle", "Images", "Merchant", "NFL", "PLAsTiCC",\
     					"Protein", "Quora", "Revenue", "Santa", "Whale"]
     
-    competitions = [key for key in average_gains.keys()]
+    # Mapping from every word of a competition name to the competition's index
+    word_to_comp = {}
+    for comp_idx, competition in enumerate(result.competitions):
+    	for word in competition.split("-"): word_to_comp[word] = comp_idx
+
     sorted_competitions = []
     for name in shortened_names:
     	if name not in ["NFL", "PLAsTiCC"]: name = name[0].lower() + name[1:]
-    	for competition in competitions:
-    		if name in competition.split("-"): sorted_competitions.append(competition)
+    	if name in word_to_comp: sorted_competitions.append(word_to_comp[name])
 
     count = 0
-    for competition in sorted_competitions: 
+    for comp_idx in sorted_competitions: 
         # Don't plot the NFL competition since we don't
         # have enough data about it
-        competitors = get_competitors(competition, user_info)
-        original_score = compute_welfare(competitors, user_info)
-        bars1.append(original_score)
-        point_gain = average_gains[competition]
-        bars2.append(point_gain)
+        bars1.append(float(result.before_welfare[comp_idx]))
+        bars2.append(float(result.gains[comp_idx]))
         r.append(count)
         count += 1
                 
@@ -350,136 +296,401 @@ def plot_point_gains(average_gains, user_info, save_plots=False):
     barWidth = 1
 
     # Just plot point gains
-    plot_point_gains_simple(r, bars2, barWidth, shortened_names, save_plots)
-     
-    fig = plt.figure(figsize=(12.5, 7.5))
-    # Create brown bars
-    plt.bar(r, bars1, edgecolor='white', width=barWidth)
-    # Create green bars (middle), on top of the first ones
-    plt.bar(r, bars2, bottom=bars1, edgecolor='white', width=barWidth)
-     
-    # Custom X axis
-    plt.xticks(r, shortened_names, fontweight='bold')
-    plt.xlabel("Competition")
-    
-    #Custom Y axis
-    plt.ylabel("Points (Before:Blue and After:Orange)")
+    plot_point_gains_simple(plots, r, bars2, barWidth, shortened_names)
+
+    plots.add("point_gains", "plots/point_gains", r=r, bars1=bars1, bars2=bars2, bar_width=barWidth, names=shortened_names)
+
+
+# Computes the SimulationResult of one configuration, see perform_simulation
+# Tier frequencies are only counted if with_frequencies is true
+def compute_simulation_result(users, gold_competition, normal_competition_names, num_retained,\
+							probabilities, limit_entries=False, rng=None, analytic=False, tolerance=None,\
+							max_iterations=100, common=None, with_frequencies=False):
+	# Integer IDs and the baseline state shared by every allocation; allocations
+	# only record the users they add instead of copying the competitor lists
+	with phase("baseline"):
+		user_names, user_points, name_to_id = users.index()
+		store = get_leaderboard_store()
+		competitor_ids = [store.competitor_ids(name, name_to_id) for name in normal_competition_names]
+		gold_ids = get_ranked_competitor_ids(gold_competition, users)
+		# Only keep the top "num_retained" in the gold competition
+		eliminated_ids = gold_ids[num_retained:]
+		baseline = BaselineState(user_points, competitor_ids, eliminated_ids, num_retained)
+
+	# Tier frequencies after every allocation drawn, one table per batch
+	frequencies_before = competition_tier_counts(competitor_ids, users.tiers) if with_frequencies else None
+	iteration_frequencies = []
+	def count_tiers(assignments):
+		added = assignments.transpose(0, 2, 1) & ~baseline.present
+		iteration_frequencies.append(iteration_tier_counts(frequencies_before, added, users.tiers[eliminated_ids]))
+
+	half_widths, num_iterations = None, None
+	if analytic:
+		with phase("allocation"): inclusion = inclusion_probabilities(probabilities, limit_entries, rng=rng)
+		with phase("welfare"): mean_gains = expected_gains(baseline, inclusion)
+	else:
+		# Average across random allocations
+		stats, assignments = simulate_until_converged(baseline, probabilities, tolerance=tolerance,\
+													max_iterations=max_iterations, limit_entries=limit_entries,\
+													rng=rng, common=common, on_batch=count_tiers if with_frequencies else None)
+		mean_gains = stats.mean
+		half_widths = stats.half_width()
+		num_iterations = stats.count
+
+	result = SimulationResult(gold_competition, normal_competition_names, num_retained, baseline.before, mean_gains,\
+							half_widths=half_widths, num_iterations=num_iterations,\
+							gold_frequencies=competition_tier_counts([gold_ids], users.tiers)[0])
+
+	if with_frequencies:
+		# Analytic results are plotted after a single allocation
+		if analytic: count_tiers(draw_assignments(len(eliminated_ids), probabilities, 1, limit_entries, rng))
+		result.frequencies_before = frequencies_before
+		result.iteration_frequencies = np.concatenate(iteration_frequencies)
+		result.frequencies_after = result.iteration_frequencies[-1]
 
-    plt.title("Points gained due to reallocation")
+	return result
 
-    if save_plots: fig.savefig("plots/point_gains", dpi=fig.dpi)
-    else: plt.show()
+
+# Returns the fingerprint of the loaded user data and leaderboards, computing it on first use
+def get_data_fingerprint(users):
+	global data_fingerprint
+	if data_fingerprint is None: data_fingerprint = dataset_fingerprint(users, get_leaderboard_store())
+	return data_fingerprint
 
 
 # Perform the simulation
-def perform_simulation(user_data, gold_competition, normal_competition_names, num_retained, make_plots, save_plots):
-	# mapping from expert, master, and grandmaster usernames to (tier, points)
-	user_info = get_user_info(user_data)
+# rng is a np.random.Generator used for the random allocations
+# If analytic is true the expected gains are computed exactly instead of
+# being averaged over random allocations. Otherwise allocations are drawn until
+# every competition's gain is known to within +/- tolerance points (at 95%
+# confidence) or max_iterations is reached; without a tolerance exactly
+# max_iterations allocations are drawn. common optionally holds the
+# CommonRandomNumbers to draw allocations from instead of rng.
+# Plots are collected into plots if it is given and rendered by the caller,
+# otherwise they are rendered (by plot_workers processes) before returning.
+# If cache is a ResultCache and seed (an int or a np.random.SeedSequence) is
+# what rng was created from, results are read from and written to the cache.
+# payouts maps competitions to payouts, by default competitions_to_payouts,
+# and the gains are only printed if verbose is true. payout_edges are the
+# upper edges of the payout buckets of the payout plots.
+# Returns a SimulationResult.
+def perform_simulation(users, gold_competition, normal_competition_names, num_retained, make_plots, save_plots,\
+						limit_entries=False, rng=None, analytic=False, tolerance=None, max_iterations=100,\
+						common=None, plots=None, plot_workers=1, cache=None, seed=None, payouts=None, verbose=True,\
+						payout_edges=PAYOUT_EDGES):
+	# Find the assignment probabilities for the remaining 11 competitions
+	if payouts is None: payouts = competitions_to_payouts
+	normal_payouts = [payouts[name] for name in normal_competition_names]
+	norm_const = sum(normal_payouts)
+	probabilities = [x / norm_const for x in normal_payouts]
 
-	gold_competitors_info = get_competitors(gold_competition, user_info)
-	
-	# Mapping from competition name to list of lists of form [competitor name, (tier, points)
-	normal_competitors_info = {}
-	for name in normal_competition_names: normal_competitors_info[name] = get_competitors(name, user_info)
+	result, cache_key = None, None
+	if cache is not None and seed is not None:
+		if isinstance(seed, np.random.SeedSequence): seed = [seed.entropy, list(seed.spawn_key)]
+		cache_key = cache.key(data=get_data_fingerprint(users), gold_competition=gold_competition,\
+							competitions=normal_competition_names, num_retained=num_retained,\
+							probabilities=probabilities, limit_entries=limit_entries, analytic=analytic,\
+							tolerance=tolerance, max_iterations=max_iterations, seed=seed,\
+							common_seed=common.seed_seq.entropy if common is not None else None)
+		with phase("cache"): result = cache.get(cache_key)
+		# Entries written without plots do not have the tier frequencies
+		if result is not None and make_plots and result.frequencies_after is None: result = None
+
+	if result is None:
+		result = compute_simulation_result(users, gold_competition, normal_competition_names, num_retained,\
+											probabilities, limit_entries, rng, analytic, tolerance,\
+											max_iterations, common, with_frequencies=make_plots)
+		if cache_key is not None:
+			with phase("cache"): cache.put(cache_key, result)
+
+	for comp_idx, name in enumerate(normal_competition_names):
+		if not verbose: break
+		if analytic: print ("Competition " + name + " gained " + str(float(result.gains[comp_idx])) + " points.")
+		else: print ("Competition " + name + " gained " + str(float(result.gains[comp_idx])) + " points (+/- "\
+					+ str(round(float(result.half_widths[comp_idx]), 2)) + " at 95% confidence).")
+	if verbose and not analytic: print ("Averaged over " + str(result.num_iterations) + " allocations.")
+
+	if make_plots:
+		with phase("plotting"):
+			# Plot competitor info and payout by category best fit lines BEFORE reallocation,
+			# then the same and the marginal gains AFTER reallocation
+			queue = plots if plots is not None else PlotQueue()
+			plot_competitor_info(queue, result, after_comp=False)
+			plot_payout_category_bars(queue, result, False, payout_edges)
+			plot_payout_category_bars(queue, result, True, payout_edges)
+			plot_competitor_info(queue, result, after_comp=True)
+			plot_point_gains(queue, result)
+			if plots is None: queue.render(save_plots, plot_workers)
 
-	# Only keep the top "num_retained" in the gold competition
-	gold_competitors_retained_info = gold_competitors_info[:num_retained]
-	gold_competitors_eliminated_info = gold_competitors_info[num_retained:]
+	return result
 
-	if make_plots: plot_competitor_info(normal_competitors_info, gold_competitors_info, after_comp=False, save_plots=save_plots)
 
-	# Find the assignment probabilities for the remaining 11 competitions
-	normal_payouts = [45000., 25000., 60000., 37000., 25000., 80000., 25000., 50000., 25000., 25000., 25000.]
-	norm_const = sum(normal_payouts)
-	probabilities = [x / norm_const for x in normal_payouts]
+# Simulates num_rounds seasons in which points accrue and the gold cut
+# changes, see DynamicSimulation. Metrics are written to out_dir.
+def perform_dynamic_simulation(users, gold_competition, normal_competition_names, num_retained, num_rounds,\
+								out_dir, limit_entries=False, rng=None):
+	user_names, user_points, name_to_id = users.index()
+	store = get_leaderboard_store()
 
-	# Plot payout by category best fit lines BEFORE reallocation
-	if make_plots: plot_payout_category_bars(gold_competitors_info, normal_competitors_info, False, save_plots=save_plots)
+	normal_payouts = [competitions_to_payouts[name] for name in normal_competition_names]
+	probabilities = [x / sum(normal_payouts) for x in normal_payouts]
+	num_teams = [len(store.usernames(name)) for name in [gold_competition] + normal_competition_names]
 
-	# Average across 100 allocations
-	average_gains = {}
-	for name in normal_competition_names: average_gains[name] = 0.0
-	num_iterations = 100
+	simulation = DynamicSimulation(user_points, users.tiers, store.competitor_ids(gold_competition, name_to_id),\
+									[store.competitor_ids(name, name_to_id) for name in normal_competition_names],\
+									num_teams, probabilities, num_retained, limit_entries=limit_entries, rng=rng)
+	simulation.run(num_rounds, out_dir)
+	print ("Wrote the metrics of " + str(num_rounds) + " rounds to " + out_dir)
+	return simulation
 
-	normal_competitors_info_updated = None
-	for simulation_index in range(num_iterations):
-		# Allocate eliminated competitors to other competitions
-		normal_competitors_info_updated = allocate_eliminated(gold_competitors_eliminated_info, normal_competition_names, probabilities, copy.deepcopy(normal_competitors_info))
 
-		# Compute gains from reallocation 
-		gains = compute_gains(normal_competitors_info, normal_competitors_info_updated, user_info)
-		for name in normal_competition_names: average_gains[name] = average_gains[name] + gains[name]
-	
-	for key in average_gains.keys(): 
-		average_gains[key] /= num_iterations
-		print ("Competition " + key + " gained " + str(average_gains[key]) + " points.")
+# Evaluates scenarios with any number of gold competitions, see ScenarioEngine
+# Returns an array of shape (scenarios, competitions) of average gains
+def perform_scenarios(users, scenarios, competition_names, num_iterations, limit_entries=False, rng=None, verbose=True):
+	user_names, user_points, name_to_id = users.index()
+
+	ranked_ids = [get_ranked_competitor_ids(name, users) for name in competition_names]
+	membership = membership_matrix(ranked_ids, len(user_names))
+
+	gains = evaluate_scenarios(user_points, membership, ranked_ids, competition_names, scenarios,\
+								num_iterations, limit_entries=limit_entries, rng=rng)
 
-	# Plot payout by category best fit lines, competitor info and marginal gains AFTER reallocation
-	if make_plots: 
-		plot_payout_category_bars(gold_competitors_info, normal_competitors_info_updated, True, save_plots=save_plots)
-		plot_competitor_info(normal_competitors_info_updated, after_comp=True, save_plots=save_plots)
-		plot_point_gains(average_gains, user_info, save_plots=save_plots)
+	for scenario_idx, scenario in enumerate(scenarios):
+		if not verbose: break
+		gold = ", ".join(name + " (" + str(cap) + " retained)" for name, cap in scenario.gold_caps.items())
+		print ("Gold competitions: " + gold)
+		for comp_idx, name in enumerate(competition_names):
+			if name in scenario.gold_caps: continue
+			print ("Competition " + name + " gained " + str(float(gains[scenario_idx, comp_idx])) + " points.")
 
-	return average_gains
+	return gains
+
+
+# Parses --gold arguments of the form name or name:cap
+def parse_gold_caps(gold_args, default_cap):
+	result = {}
+	for arg in gold_args:
+		name, _, cap = arg.partition(":")
+		result[name] = int(cap) if cap else default_cap
+	return result
 
 
-def find_best_num_retained(user_data, gold_competition, normal_competition_names, args):
-	global num_retained
+# Runs a single point of the num_retained sweep; kept at module
+# level so that it can be sent to worker processes. Returns the
+# average gain, the plots collected for the point, if any, and the
+# point's profile. The point is only profiled if trace_allocations is
+# not None, and then traces allocations if it is true. Results are
+# cached in cache, if given, when the sweep is seeded.
+def simulate_sweep_point(users, gold_competition, normal_competition_names, save_plots, payout_edges,\
+						limit_entries, analytic, tolerance, max_iterations, common, trace_allocations,\
+						cache, seeded, sweep_point):
+	k, seed_seq, make_plots = sweep_point
+	plots = PlotQueue()
+
+	# Every point gets its own profiler, so points run by worker processes are profiled too
+	profiler = None
+	if trace_allocations is not None: profiler = PhaseProfiler(trace_allocations, "num_retained=" + str(k)).start()
+	try:
+		result = perform_simulation(users, gold_competition, normal_competition_names,\
+									k, make_plots=make_plots, save_plots=save_plots,\
+									limit_entries=limit_entries, rng=np.random.default_rng(seed_seq), analytic=analytic,\
+									tolerance=tolerance, max_iterations=max_iterations, common=common, plots=plots,\
+									cache=cache, seed=seed_seq if seeded else None, payout_edges=payout_edges)
+	finally:
+		if profiler is not None: profiler.stop()
+
+	# Compute the average total gain for the given choice of num_retained
+	return result.mean_gain(), plots.specs, profiler.report() if profiler is not None else []
+
+
+# Runs perform_simulation for every num_retained in x_vals. Returns the
+# average gain of every point and the plots collected along the way.
+def sweep_num_retained(users, gold_competition, normal_competition_names, args, x_vals=range(25, 250, 5)):
+	# Every sweep point gets its own independent stream spawned from the
+	# seed, so results do not depend on the number of workers
+	seed_seqs = np.random.SeedSequence(args.seed).spawn(len(x_vals))
+
+	# Every sweep point's plots are saved under the same file names, so
+	# only the plots of the last point (the ones that used to end up on
+	# disk) are made
+	make_plots = [args.plot and k == x_vals[-1] for k in x_vals]
+	sweep_points = list(zip(x_vals, seed_seqs, make_plots))
+
+	# Under common random numbers every sweep point reuses the same per-user
+	# draws, so differences between points are not swamped by sampling noise
+	common = None
+	if args.common_random_numbers:
+		gold_ids = get_leaderboard_store().competitor_ids(gold_competition, users.index()[2])
+		common = CommonRandomNumbers(gold_ids, len(normal_competition_names), args.seed)
+
+	profiler = current_profiler()
+	run_point = partial(simulate_sweep_point, users, gold_competition, normal_competition_names,\
+						args.save, tuple(getattr(args, "payout_edges", PAYOUT_EDGES)), args.limit_entries, args.analytic,\
+						args.tolerance, args.max_iterations, common,\
+						profiler.trace_allocations if profiler is not None else None,\
+						getattr(args, "cache", None), args.seed is not None)
+
+	# Fill with average gains for given num_retained value
+	if args.workers == 1: results = [run_point(point) for point in sweep_points]
+	else:
+		from concurrent.futures import ProcessPoolExecutor
+		with ProcessPoolExecutor(max_workers=args.workers) as executor:
+			results = list(executor.map(run_point, sweep_points))
+	y_vals = [result[0] for result in results]
+
+	plots = PlotQueue()
+	for result in results:
+		plots.extend(result[1])
+		if profiler is not None: profiler.merge(result[2])
+	return y_vals, plots
+
+
+def find_best_num_retained(users, gold_competition, normal_competition_names, args):
 	x_vals = range(25, 250, 5)
-	y_vals = []  # Fill with average gains for given num_retained value
-	
-	for k in x_vals:
-		num_retained = k
-		average_gains = perform_simulation(user_data, gold_competition, normal_competition_names,\
-										num_retained, make_plots=args.plot, save_plots=args.save)
-		# Compute the average total gain for the given choice of num_retained
-		y_vals.append(sum([gain for gain in average_gains.values()]) / float(len(average_gains)))
-
-	fig = plt.figure(figsize=(12.5, 7.5))
-	plt.plot(x_vals, y_vals)
-	plt.xlabel("Number of competitors in the gold competition")
-	plt.ylabel("Average gain after reallocation")
-	plt.title("Average gain vs. number retained in gold competition")
-	if args.save: fig.savefig("plots/best_num_retained", dpi=fig.dpi)
-	else: plt.show()
+	y_vals, plots = sweep_num_retained(users, gold_competition, normal_competition_names, args, x_vals)
+
+	# Plots are only rendered once the whole sweep is done
+	plots.add("best_num_retained", "plots/best_num_retained", x_vals=list(x_vals), y_vals=y_vals)
+	with phase("plotting"): plots.render(args.save, args.plot_workers)
 
 	max_gain_index = np.argmax(y_vals)
 	print ("The value for num_retained giving the highest average gain is: " + str(x_vals[max_gain_index]))
 
 
 
-def main():
-	# Make life easier for the user
-	if not os.path.isdir("Leaderboards"): form_leaderboards_dir()
+# Finds the best num_retained in [low, high) to within step by successive halving.
+# Every round evaluates all remaining candidates in one batch with shared random
+# draws, keeps the best 1 / eta of them and multiplies the number of allocations
+# per candidate by eta, so most of the budget is spent near the optimum.
+def search_best_num_retained(users, gold_competition, competition_names, args, low=25, high=250,\
+							initial_iterations=2, eta=3):
+	candidates = np.arange(low, high, args.step)
+	gain_sums = np.zeros(len(candidates))
+	counts = np.zeros(len(candidates))
 
-	# Load user data (experts, masters, and grandmasters)
-	user_data = np.load("kaggle_users.npy")
+	seed_seq = np.random.SeedSequence(args.seed)
+	iterations = initial_iterations
+	total_iterations = 0
 
-	# Get a list of competition names
-	competition_names = ["-".join(name.split('.')[0].split('-')[:-1]) for name in os.listdir("Leaderboards") if name != ".DS_Store"]
+	while len(candidates) > 1:
+		scenarios = [Scenario({gold_competition: int(k)}, competitions_to_payouts) for k in candidates]
+		gains = perform_scenarios(users, scenarios, competition_names, iterations, limit_entries=args.limit_entries,\
+									rng=np.random.default_rng(seed_seq.spawn(1)[0]), verbose=False)
 
-	# Just one "gold" competition in version 1
-	gold_competition = "two-sigma-financial-news"
+		# Average total gain for every candidate over all rounds so far
+		gain_sums += np.nanmean(gains, axis=1) * iterations
+		counts += iterations
+		total_iterations += iterations * len(candidates)
+		print ("Evaluated " + str(len(candidates)) + " candidates with " + str(iterations) + " allocations each")
 
-	# The rest are normal competitions
-	normal_competition_names = [name for name in competition_names if name != gold_competition]
+		keep = np.argsort(-(gain_sums / counts), kind="stable")[:max(1, int(np.ceil(len(candidates) / float(eta))))]
+		candidates, gain_sums, counts = candidates[keep], gain_sums[keep], counts[keep]
+		iterations *= eta
+
+	print ("Used " + str(total_iterations) + " allocations in total")
+	print ("The value for num_retained giving the highest average gain is: " + str(candidates[0]))
+	return candidates[0]
 
 
+def main():
 	# Simulate the reassignment
 	# If make_plots is true then we generate plots throughout
 	parser = argparse.ArgumentParser()
 	parser.add_argument("-p", "--plot", help="run simulation with plotting", action="store_true")
 	parser.add_argument("-s", "--save", help="save all generated plots", action="store_true")
 	parser.add_argument("-f", "--find_best_num_retained", help="Finds the best number of retained competitors in the gold competition", action="store_true")
+	parser.add_argument("-l", "--limit_entries", help="each eliminated user enters between 1 and half of the normal competitions instead of all of them", action="store_true")
+	parser.add_argument("-a", "--analytic", help="compute the expected gains exactly instead of averaging random allocations", action="store_true")
+	parser.add_argument("-t", "--tolerance", help="draw allocations until every gain is known to within +/- this many points", type=float, default=None)
+	parser.add_argument("--max_iterations", help="maximum number of allocations drawn (exactly this many without --tolerance)", type=int, default=100)
+	parser.add_argument("-c", "--common_random_numbers", help="reuse the same random draws for every point of --find_best_num_retained", action="store_true")
+	parser.add_argument("-g", "--gold", help="gold competition, optionally with its cap as name:cap; repeat for several gold competitions (no plots, analytic mode or caching)", action="append")
+	parser.add_argument("--search", help="find the best number retained by successive halving instead of a fixed grid", action="store_true")
+	parser.add_argument("--step", help="granularity of --search", type=int, default=1)
+	parser.add_argument("-w", "--workers", help="number of processes used by --find_best_num_retained", type=int, default=1)
+	parser.add_argument("--plot_workers", help="number of processes used to render saved plots", type=int, default=1)
+	parser.add_argument("--seed", help="seed for the random allocations", type=int, default=None)
+	parser.add_argument("--rounds", help="simulate this many seasons in which points accrue and the gold cut changes", type=int, default=None)
+	parser.add_argument("--rounds_dir", help="directory the metrics of every round are written to", default="rounds")
+	parser.add_argument("--payout_edges", help="upper edges of the payout buckets of the payout plots", type=float, nargs='+', default=list(PAYOUT_EDGES))
+	parser.add_argument("--cache_dir", help="directory of the cache of seeded simulation results", default="simulation_cache")
+	parser.add_argument("--cache_size", help="maximum size of the result cache in MB", type=float, default=256.)
+	parser.add_argument("--no_cache", help="neither read nor write the result cache", action="store_true")
+	parser.add_argument("--profile", help="time every phase of the run (per point of the search) and print a report", action="store_true")
+	parser.add_argument("--profile_report", help="JSON file the --profile report is written to", default="profile.json")
+	parser.add_argument("--trace_allocations", help="with --profile, also count the memory allocated by every phase", action="store_true")
+	parser.add_argument("--cprofile", help="write a cProfile of the main process to this file", default=None)
 	args = parser.parse_args()
 
+	# --gold averages a fixed number of allocations of the scenario in one vectorized
+	# pass (see ScenarioEngine); it makes no plots and does not use the result cache
+	if args.gold:
+		unsupported = [("--plot", args.plot), ("--save", args.save), ("--analytic", args.analytic),\
+						("--tolerance", args.tolerance is not None), ("--workers", args.workers != 1),\
+						("--cache_dir", args.cache_dir != parser.get_default("cache_dir")),\
+						("--cache_size", args.cache_size != parser.get_default("cache_size")),\
+						("--find_best_num_retained", args.find_best_num_retained), ("--search", args.search),\
+						("--rounds", args.rounds is not None), ("--common_random_numbers", args.common_random_numbers)]
+		unsupported = [flag for flag, is_set in unsupported if is_set]
+		if unsupported: parser.error(", ".join(unsupported) + " cannot be used with --gold")
+
+		try:
+			gold_caps = parse_gold_caps(args.gold, num_retained)
+		except ValueError:
+			parser.error("--gold takes a competition name, optionally followed by :cap with an integer cap")
+
+	profiler = PhaseProfiler(args.trace_allocations).start() if args.profile else None
+	cprofiler = None
+	if args.cprofile is not None:
+		import cProfile
+		cprofiler = cProfile.Profile()
+		cprofiler.enable()
+
+	# Results of seeded runs are cached, so re-plotting and partial re-sweeps are instant
+	args.cache = ResultCache(args.cache_dir, int(args.cache_size * 2 ** 20)) if not args.no_cache else None
+
+	with phase("data load"):
+		# Load user data (experts, masters, and grandmasters)
+		# The columnar store is created from kaggle_users.npy on first use
+		users = load_user_store("kaggle_users_store", "kaggle_users.npy")
+
+		# Get a list of competition names
+		competition_names = get_leaderboard_store().competition_names()
+
+	# Just one "gold" competition in version 1
+	gold_competition = "two-sigma-financial-news"
+
+	# The rest are normal competitions
+	normal_competition_names = [name for name in competition_names if name != gold_competition]
+
 	# We'll need a plots directory for saving generated figures
 	if args.save and not os.path.isdir("plots"): os.mkdir("plots")
 
-	if args.find_best_num_retained: find_best_num_retained(user_data, gold_competition,\
+	if args.gold:
+		unknown = [name for name in gold_caps if name not in competition_names]
+		if unknown: parser.error("unknown gold competitions: " + ", ".join(unknown))
+		scenario = Scenario(gold_caps, competitions_to_payouts)
+		perform_scenarios(users, [scenario], competition_names, args.max_iterations,\
+						limit_entries=args.limit_entries, rng=np.random.default_rng(args.seed))
+	elif args.rounds is not None:
+		perform_dynamic_simulation(users, gold_competition, normal_competition_names, num_retained, args.rounds,\
+									args.rounds_dir, limit_entries=args.limit_entries, rng=np.random.default_rng(args.seed))
+	elif args.search: search_best_num_retained(users, gold_competition, competition_names, args)
+	elif args.find_best_num_retained: find_best_num_retained(users, gold_competition,\
 															normal_competition_names, args)
-	else: perform_simulation(user_data, gold_competition, normal_competition_names,\
-							num_retained, make_plots=args.plot, save_plots=args.save)
+	else: perform_simulation(users, gold_competition, normal_competition_names,\
+							num_retained, make_plots=args.plot, save_plots=args.save,\
+							limit_entries=args.limit_entries, rng=np.random.default_rng(args.seed), analytic=args.analytic,\
+							tolerance=args.tolerance, max_iterations=args.max_iterations, plot_workers=args.plot_workers,\
+							cache=args.cache, seed=args.seed, payout_edges=tuple(args.payout_edges))
+
+	if cprofiler is not None:
+		cprofiler.disable()
+		cprofiler.dump_stats(args.cprofile)
+	if profiler is not None:
+		profiler.print_report()
+		profiler.write_report(args.profile_report)
+		profiler.stop()
 	
 
 if __name__ == "__main__":